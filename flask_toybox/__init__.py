@@ -1,6 +1,6 @@
 from __future__ import absolute_import
 
-from .serialization import JSON
+from .serialization import JSON, NDJSON, MessagePack, CBOR
 from .compat import OrderedDict
 
 class ToyBox(object):
@@ -9,8 +9,25 @@ class ToyBox(object):
         self.init_app(app)
 
     def init_app(self, app):
-        app.config.setdefault("TOYBOX_SERIALIZERS", OrderedDict([
+        serializers = OrderedDict([
             ("application/json", JSON),
             ("text/json", JSON),
-        ]))
-        app.config.setdefault("TOYBOX_DESERIALIZERS", set([JSON]))
+            ("application/x-ndjson", NDJSON),
+        ])
+        # NDJSON bodies are lists, that views expecting a single object
+        # can't handle, so it's available only as a response format.
+        deserializers = set([JSON])
+        # Binary formats are available only if their libraries are installed.
+        if MessagePack is not None:
+            serializers["application/msgpack"] = MessagePack
+            deserializers.add(MessagePack)
+        if CBOR is not None:
+            serializers["application/cbor"] = CBOR
+            deserializers.add(CBOR)
+        app.config.setdefault("TOYBOX_SERIALIZERS", serializers)
+        app.config.setdefault("TOYBOX_DESERIALIZERS", deserializers)
+        app.config.setdefault("TOYBOX_COMPRESSION", True)
+        app.config.setdefault("TOYBOX_COMPRESSION_LEVEL", 6)
+        app.config.setdefault("TOYBOX_COMPRESSION_MIN_SIZE", 500)
+        app.config.setdefault("TOYBOX_COMPRESSION_FLUSH_SIZE", 8192)
+        app.config.setdefault("TOYBOX_ETAG_ALGORITHM", "blake2b")
@@ -0,0 +1,218 @@
+"""
+Caching of serialized view results.
+
+A `ResultCache` holds arbitrary values, each tagged with a set of names (for
+SQLAlchemy views, names of the tables the result was loaded from). When any
+of the tags is invalidated, all the values tagged with it become stale.
+
+Storage is delegated to a backend, which is any object with `get(key,
+default=None)`, `set(key, value, ttl=None)` and `delete(key)` methods (for
+example, `utils.LRUCache`, which is used by default). If a backend is shared
+between processes (say, it's a `SharedMemoryCache`, or a wrapper around
+memcached client), then the invalidations are shared too, as tags' versions
+are kept in the backend. Keys passed to backend are strings, and values are
+tuples of strings and whatever was cached (view responses are cached as
+tuples of strings), so they may be serialized with `marshal`.
+"""
+
+from __future__ import absolute_import
+
+from .utils import LRUCache
+import hashlib
+import uuid
+import os
+import stat
+import time
+import marshal
+import tempfile
+import weakref
+
+# All the alive caches, so they can be invalidated at once.
+_caches = weakref.WeakSet()
+
+def invalidate_all(tags):
+    """
+    Invalidates given tags in all result caches.
+    """
+    for cache in _caches:
+        cache.invalidate(tags)
+
+class ResultCache(object):
+    """
+    Tagged cache with pluggable storage backend. If no `backend` is given,
+    an in-process `LRUCache` with `max_size` items is used. Values expire
+    after `ttl` seconds (if it's not `None`), regardless of invalidations.
+    """
+    def __init__(self, backend=None, max_size=1000, ttl=300, prefix="toybox"):
+        self.backend = backend if backend is not None else LRUCache(max_size)
+        self.ttl = ttl
+        self.prefix = prefix
+        _caches.add(self)
+
+    def make_key(self, key):
+        return "{0}:{1}".format(self.prefix, hashlib.sha1(repr(key)).hexdigest())
+
+    def _tag_key(self, tag):
+        return "{0}:tag:{1}".format(self.prefix, tag)
+
+    def get_versions(self, tags):
+        """
+        Returns a tuple of current versions of `tags`.
+        """
+        versions = []
+        for tag in sorted(tags):
+            version = self.backend.get(self._tag_key(tag), None)
+            if version is None:
+                # Never invalidated, or evicted from the backend.
+                version = self.invalidate([tag])
+            versions.append(version)
+        return tuple(versions)
+
+    def lookup(self, key, tags):
+        """
+        Returns a tuple of cached value (or `None` if it's missing or stale)
+        and current versions of `tags`. Versions must be passed to `store`,
+        and they're looked up before the value is computed, so whatever is
+        invalidated during computation is not cached as fresh.
+        """
+        versions = self.get_versions(tags)
+        entry = self.backend.get(self.make_key(key), None)
+        if entry is None or entry[0] != versions:
+            return None, versions
+        return entry[1], versions
+
+    def store(self, key, value, versions, ttl=None):
+        self.backend.set(self.make_key(key), (versions, value),
+                         ttl if ttl is not None else self.ttl)
+
+    def invalidate(self, tags):
+        """
+        Makes all values, tagged with any of `tags`, stale.
+        """
+        version = uuid.uuid4().hex
+        for tag in tags:
+            self.backend.set(self._tag_key(tag), version, None)
+        return version
+
+class SharedMemoryCache(object):
+    """
+    Cache backend, that keeps values in files under `path`, so it's shared
+    between all processes of the user on the host (for example, pre-forked
+    workers). By default, a per-user directory in `/dev/shm` (that's
+    memory-backed on Linux) is used if it's available, and in temporary
+    directory otherwise.
+
+    The directory must be owned by the current user and inaccessible to
+    others (it's created so if it's missing), as anyone who could write
+    there could poison the cache. Values are stored with `marshal`, so only
+    strings, numbers, tuples, lists, dicts and `None` can be cached.
+
+    Writes are atomic (files are renamed into place). Expired values are
+    removed when they're read, and every `prune_every` writes the cache is
+    pruned: expired values are removed, and then the oldest written ones,
+    if there are more than `max_entries`.
+    """
+    def __init__(self, path=None, ttl=None, max_entries=10000, prune_every=100):
+        if path is None:
+            base = "/dev/shm" if os.path.isdir("/dev/shm") else tempfile.gettempdir()
+            path = os.path.join(base, "flask-toybox-{0}".format(os.getuid()))
+        try:
+            os.mkdir(path, 0o700)
+        except OSError:
+            # Exists already, or created by another process meanwhile
+            pass
+        info = os.lstat(path)
+        if (not stat.S_ISDIR(info.st_mode) or info.st_uid != os.getuid()
+                or info.st_mode & 0o077):
+            raise ValueError("Cache directory {0} must be owned by the current"
+                             " user and inaccessible to others".format(path))
+        self.path = path
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.prune_every = prune_every
+        self._writes = 0
+
+    def _filename(self, key):
+        return os.path.join(self.path, hashlib.sha1(key).hexdigest())
+
+    @staticmethod
+    def _read_expires(f):
+        # Expiration time is kept on a separate first line, so the cache
+        # could be pruned without loading values.
+        expires = f.readline(32).strip()
+        return float(expires) if expires else None
+
+    def get(self, key, default=None):
+        try:
+            with open(self._filename(key), "rb") as f:
+                expires = self._read_expires(f)
+                if expires is not None and expires < time.time():
+                    value = default
+                else:
+                    return marshal.loads(f.read())
+        except (IOError, OSError, EOFError, ValueError, TypeError):
+            return default
+        self.delete(key)
+        return value
+
+    def set(self, key, value, ttl=None):
+        ttl = ttl if ttl is not None else self.ttl
+        expires = repr(time.time() + ttl) if ttl is not None else ""
+        data = marshal.dumps(value)
+        fd, tmp = tempfile.mkstemp(prefix=".tmp", dir=self.path)
+        try:
+            with os.fdopen(fd, "wb") as f:
+                f.write(expires.encode("ascii") + b"\n")
+                f.write(data)
+            os.rename(tmp, self._filename(key))
+        except Exception:
+            os.unlink(tmp)
+            raise
+        self._writes += 1
+        if self.prune_every and self._writes % self.prune_every == 0:
+            self.prune()
+
+    def delete(self, key):
+        try:
+            os.unlink(self._filename(key))
+        except OSError:
+            pass
+
+    def prune(self):
+        """
+        Removes expired values, and then the oldest written values, if
+        there are more than `max_entries` left.
+        """
+        now = time.time()
+        entries = []
+        for name in os.listdir(self.path):
+            filename = os.path.join(self.path, name)
+            try:
+                if name.startswith(".tmp"):
+                    # Leftovers of crashed writes
+                    if os.stat(filename).st_mtime < now - 60:
+                        os.unlink(filename)
+                    continue
+                with open(filename, "rb") as f:
+                    expires = self._read_expires(f)
+                    mtime = os.fstat(f.fileno()).st_mtime
+                if expires is not None and expires < now:
+                    os.unlink(filename)
+                else:
+                    entries.append((mtime, filename))
+            except (IOError, OSError, ValueError):
+                continue
+        if self.max_entries is not None and len(entries) > self.max_entries:
+            entries.sort()
+            for mtime, filename in entries[:len(entries) - self.max_entries]:
+                try:
+                    os.unlink(filename)
+                except OSError:
+                    pass
+
+    def clear(self):
+        for name in os.listdir(self.path):
+            try:
+                os.unlink(os.path.join(self.path, name))
+            except OSError:
+                pass
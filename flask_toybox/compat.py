@@ -8,6 +8,36 @@ try:
 except ImportError: # pragma: no cover
     from ordereddict import OrderedDict
 
+# UTC timezone is available in the standard library only on Python 3.2+.
+try:
+    from datetime import timezone
+    utc = timezone.utc
+except ImportError: # pragma: no cover
+    from datetime import tzinfo, timedelta
+
+    class UTC(tzinfo):
+        def utcoffset(self, dt):
+            return timedelta(0)
+
+        def tzname(self, dt):
+            return "UTC"
+
+        def dst(self, dt):
+            return timedelta(0)
+
+        def __repr__(self):
+            return "UTC"
+
+    utc = UTC()
+
+# Streaming with request context is available only in Flask 0.9+. On older
+# versions streamed responses can't access `request` once the view returns,
+# so they're not streamed at all (see `NegotiatingMethodView`).
+try:
+    from flask import stream_with_context
+except ImportError: # pragma: no cover
+    stream_with_context = None
+
 # PATCH method was recognized only in Flask 0.9+, so monkey patching is needed
 # for older versions. Not pretty, but does the job and shouldn't have any
 # bad consequences.
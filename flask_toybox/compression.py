@@ -0,0 +1,90 @@
+"""
+Response compression (HTTP content-coding) support.
+
+Responses are compressed with `gzip` or `deflate`, depending on what client
+prefers, as told by `Accept-Encoding` request header. Compression is
+configured using the following settings:
+
+- `TOYBOX_COMPRESSION` - set to `False` to disable compression.
+- `TOYBOX_COMPRESSION_LEVEL` - zlib compression level, from 1 to 9.
+- `TOYBOX_COMPRESSION_MIN_SIZE` - responses shorter than this number of
+  bytes are not compressed. Streamed responses are always compressed, as
+  their length is not known in advance.
+- `TOYBOX_COMPRESSION_FLUSH_SIZE` - streamed responses are flushed every
+  time this number of uncompressed bytes is passed through, so clients get
+  the data as it's produced, not only when the compressor's buffer fills.
+"""
+
+from __future__ import absolute_import
+import zlib
+
+# Encodings in the order of server preference, and zlib `wbits` to use.
+ENCODINGS = [
+    ("gzip", 16 + zlib.MAX_WBITS),
+    ("deflate", zlib.MAX_WBITS),
+]
+
+def negotiate_encoding(accept_encodings):
+    """
+    Given a `werkzeug.datastructures.Accept` object, returns the name of
+    content-coding to use, or `None` if response should not be compressed.
+    """
+    best_name, best_quality = None, 0
+    for name, wbits in ENCODINGS:
+        quality = accept_encodings.quality(name)
+        if quality > best_quality:
+            best_name, best_quality = name, quality
+    return best_name
+
+def _compressor(encoding, level):
+    return zlib.compressobj(level, zlib.DEFLATED, dict(ENCODINGS)[encoding])
+
+def _compress_iter(chunks, encoding, level, flush_size):
+    compressor = _compressor(encoding, level)
+    pending = 0
+    for chunk in chunks:
+        if isinstance(chunk, unicode):
+            chunk = chunk.encode("utf-8")
+        data = compressor.compress(chunk)
+        pending += len(chunk)
+        if pending >= flush_size:
+            data += compressor.flush(zlib.Z_SYNC_FLUSH)
+            pending = 0
+        if data:
+            yield data
+    yield compressor.flush()
+
+def compress_response(response, encoding, level=6, min_size=0,
+                      flush_size=8192):
+    """
+    Compresses the response body in-place using given content-coding,
+    if it makes sense. Streamed responses are compressed on the fly, and
+    flushed after every `flush_size` bytes of input.
+
+    Strong ETag of the response, if any, gets the encoding name appended,
+    as the compressed representation is a different variant. `ETagger`
+    understands such tags in conditional requests.
+
+    Returns the response.
+    """
+    if (encoding is None or response.direct_passthrough
+            or response.status_code < 200 or response.status_code in (204, 304)
+            or "Content-Encoding" in response.headers):
+        return response
+
+    if response.is_streamed:
+        response.response = _compress_iter(response.response, encoding,
+                                           level, flush_size)
+        response.headers.pop("Content-Length", None)
+    else:
+        data = response.data
+        if len(data) < min_size:
+            return response
+        compressor = _compressor(encoding, level)
+        response.data = compressor.compress(data) + compressor.flush()
+
+    response.headers["Content-Encoding"] = encoding
+    etag, weak = response.get_etag()
+    if etag is not None and not weak:
+        response.set_etag("{0}-{1}".format(etag, encoding))
+    return response
@@ -1,13 +1,32 @@
 from __future__ import absolute_import
 
 from .exceptions import PreconditionRequired, NotModified
+from .compression import ENCODINGS
 from flask import abort
 import base64
 import hashlib
-import types
 
 METHODS_REQUIRE_IF_MATCH = set(["PUT", "DELETE", "PATCH"])
 
+# ETags only have to tell representations apart, not to resist attacks,
+# so a short digest of a fast hash function is enough.
+DEFAULT_ALGORITHM = "blake2b"
+DIGEST_SIZE = 16
+
+def new_hash(algorithm=None):
+    """
+    Returns a new hash object for `algorithm` (any name `hashlib` knows).
+    BLAKE2 digests are truncated to `DIGEST_SIZE` bytes. If BLAKE2 is not
+    available (it's not on Python 2), falls back to SHA-1.
+    """
+    algorithm = algorithm or DEFAULT_ALGORITHM
+    if algorithm in ("blake2b", "blake2s"):
+        constructor = getattr(hashlib, algorithm, None)
+        if constructor is not None:
+            return constructor(digest_size=DIGEST_SIZE)
+        return hashlib.sha1()
+    return hashlib.new(algorithm)
+
 def _raw_object_serialize(obj):
     """
     Unsafe serializer of raw object's content using `repr`.
@@ -21,11 +40,33 @@ def _raw_object_serialize(obj):
         yield ":"
         yield repr(d[k])
 
+def _http_time(value):
+    """
+    Converts a `datetime` to a naive UTC one, truncated to seconds (as HTTP
+    dates have no fractions). Naive values are assumed to be UTC already.
+    """
+    offset = value.utcoffset()
+    if offset is not None:
+        value = (value - offset).replace(tzinfo=None)
+    return value.replace(microsecond=0)
+
+def _etag_matches(etag, etags):
+    """
+    Checks whenever `etag` or any of its compressed variants' tags
+    (see `compression.compress_response`) is present in `etags`.
+    """
+    if etag in etags:
+        return True
+    return any("{0}-{1}".format(etag, name) in etags for name, _ in ENCODINGS)
+
 class ETagger(object):
-    def __init__(self, req, serializer):
+    def __init__(self, req, serializer, algorithm=None):
         self.etag = None
+        self.last_modified = None
         self.serializer = serializer
         self.req = req
+        self.algorithm = algorithm
+        self._serialized = None
 
     def set_etag(self, etag):
         if self.req.method in METHODS_REQUIRE_IF_MATCH:
@@ -34,29 +75,127 @@ class ETagger(object):
             # see http://trac.tools.ietf.org/wg/httpbis/trac/ticket/116
             if not self.req.if_match:
                 raise PreconditionRequired
-            elif etag not in self.req.if_match:
+            elif not _etag_matches(etag, self.req.if_match):
                 abort(412)
         elif self.req.method == "GET":
             self.etag = etag
-            if self.req.if_none_match and etag in self.req.if_none_match:
+            if self.req.if_none_match and _etag_matches(etag, self.req.if_none_match):
                 raise NotModified
 
-    def set_raw(self, data, prefix="raw"):
-        etag = hashlib.sha1()
-        if type(data) is types.GeneratorType:
-            for element in data: etag.update(element)
-        else:
+    def set_last_modified(self, last_modified, validate=True):
+        """
+        Sets the time (a `datetime`) the representation was last modified at,
+        so it's sent as `Last-Modified` response header.
+
+        If `validate` is true, raises `NotModified` for GET requests, if it's
+        not newer than `If-Modified-Since` (that is ignored if there's
+        `If-None-Match`), or aborts with 412 for modifying requests, if it's
+        newer than `If-Unmodified-Since`. Pass a false `validate` if the time
+        is only a hint, and could stay the same when representation changes.
+        """
+        last_modified = _http_time(last_modified)
+        if not validate:
+            if self.req.method == "GET":
+                self.last_modified = last_modified
+        elif self.req.method in METHODS_REQUIRE_IF_MATCH:
+            since = self.req.if_unmodified_since
+            if since is not None and last_modified > _http_time(since):
+                abort(412)
+        elif self.req.method == "GET":
+            self.last_modified = last_modified
+            since = self.req.if_modified_since
+            if (not self.req.if_none_match and since is not None
+                    and last_modified <= _http_time(since)):
+                raise NotModified
+
+    def set_raw(self, data, prefix="raw", extra=None):
+        """
+        Sets ETag to a hash of `data`, which is either a string or an
+        iterable of string chunks (say, a generator, or a list of chunks
+        produced by `serialize_iter`). Data is hashed in a single pass,
+        so generators are consumed only once.
+
+        If `extra` is not `None`, its `repr` is hashed too, so ETag could
+        cover things that aren't a part of the body (like headers).
+        """
+        etag = new_hash(self.algorithm)
+        if isinstance(data, basestring):
             etag.update(data)
-        etag.update(data)
+        else:
+            for chunk in data:
+                etag.update(chunk)
+        if extra is not None:
+            etag.update(repr(extra))
+        self._set_digest(etag, prefix)
+
+    def set_chunks(self, chunks):
+        """
+        Consumes an iterable of serialized chunks (as produced by serializer's
+        `serialize_iter`), hashing them on the way, and sets ETag. Returns
+        the list of chunks, so they could be used as a response body.
+
+        As chunks are hashed in the same way strings are, the ETag is the same
+        as the one `set_object` sets for the serialized list of items.
+        """
+        etag = new_hash(self.algorithm)
+        buffered = []
+        for chunk in chunks:
+            etag.update(chunk)
+            buffered.append(chunk)
+        self._set_digest(etag, self._serializer_name())
+        return buffered
+
+    def _set_digest(self, etag, prefix):
         digest = base64.b64encode(etag.digest()).rstrip("=")
         self.set_etag("{0}-{1}".format(prefix, digest))
 
-    def set_object(self, obj):
+    def _serializer_name(self):
+        if self.serializer is None:
+            return "none"
+        name = getattr(self.serializer, "name", None)
+        if name is None:
+            # Serializers are usually classes, not instances of them.
+            name = getattr(self.serializer, "__name__",
+                           self.serializer.__class__.__name__)
+        return name.lower()
+
+    def set_object(self, obj, extra=None):
+        pname = self._serializer_name()
         if self.serializer is not None:
-            pname = getattr(self.serializer, "name",
-                            self.serializer.__class__.__name__.lower())
-            serialize = self.serializer.serialize
+            data = self.serializer.serialize(obj)
+            # Remember the result, so the response body may reuse it.
+            self._serialized = (obj, self.serializer, data)
         else:
-            pname = "none"
-            serialize = _raw_object_serialize
-        self.set_raw(serialize(obj), pname)
\ No newline at end of file
+            data = _raw_object_serialize(obj)
+        self.set_raw(data, pname, extra)
+
+    def set_fingerprint(self, fingerprint):
+        """
+        Sets ETag, derived from `fingerprint` and serializer name, without
+        serializing anything. Fingerprint may be any value with a stable
+        `repr`, that changes whenever object's representation does (say,
+        a tuple of model name, primary key, version and access levels).
+
+        Like other setters, raises `NotModified` if ETag matches the
+        `If-None-Match` request header.
+        """
+        pname = self._serializer_name()
+        self.set_raw(repr((pname, fingerprint)), pname)
+
+    def get_serialized(self, obj, serializer):
+        """
+        Returns data previously serialized by `set_object`, if it was done
+        for the very same object (not an equal one) using the very same
+        serializer. Returns `None` otherwise.
+
+        This allows to serialize an object only once per request, and also
+        guarantees that ETag matches the bytes that are actually sent.
+        Because of this, `dehydrate` methods must return a new object instead
+        of modifying the passed one in-place.
+        """
+        if self._serialized is None:
+            return None
+        cached_obj, cached_serializer, data = self._serialized
+        if cached_obj is not obj or cached_serializer is not serializer:
+            return None
+        return data
\ No newline at end of file
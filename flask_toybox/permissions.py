@@ -1,10 +1,73 @@
 from itertools import dropwhile
 from functools import partial
+from flask import g, has_request_context
 
 DEFAULT_ACCESS_HIER = ["anonymous", "authenticated", "owner",
                        "staff", "admin", "system"]
 DEFAULT_ACCESS_TARGETS = {"r": "readable", "w": "writeable"}
 
+class PermissionInfo(dict):
+    """
+    A dict of permissions (and any other column info), as returned by `I`.
+
+    In addition to sets of level names, it holds the same permissions
+    compiled to integer bitmasks over the access hierarchy (`hier`), in
+    the `masks` attribute. Masks are computed by `compile`, so call it if
+    you modify the sets after the object was created.
+    """
+    def __init__(self, hier, *args, **kwargs):
+        super(PermissionInfo, self).__init__(*args, **kwargs)
+        self.hier = tuple(hier)
+        self.masks = {}
+
+    def compile(self, targets):
+        self.masks = dict((target, levels_mask(self.hier, self[target]))
+                          for target in targets)
+        return self
+
+_levels_masks = {}
+
+def levels_mask(hier, levels):
+    """
+    Converts a collection of access level names to an integer bitmask over
+    the access hierarchy `hier` (a tuple). Returns `None` if some level is
+    not a part of the hierarchy, and thus could not be represented.
+
+    Results are memoized, so this is cheap to call repeatedly.
+    """
+    levels = frozenset(levels)
+    key = (hier, levels)
+    try:
+        return _levels_masks[key]
+    except KeyError:
+        pass
+    mask = 0
+    for level in levels:
+        if level not in hier:
+            mask = None
+            break
+        mask |= 1 << hier.index(level)
+    if len(_levels_masks) < 10000:
+        _levels_masks[key] = mask
+    return mask
+
+def permits(info, what, levels, default=frozenset(["system"])):
+    """
+    Returns True if column with `info` (as returned by `I`) permits `what`
+    (say, `"readable"`) access to any of the given access `levels`.
+
+    If `info` has no permissions for `what`, `default` levels are assumed.
+    Compiled bitmasks are used, if available, so the check is a single
+    bitwise AND.
+    """
+    masks = getattr(info, "masks", None)
+    if masks and what in masks:
+        mask = levels_mask(info.hier, levels)
+        if mask is not None and masks[what] is not None:
+            return (masks[what] & mask) != 0
+    permitted = info.get(what, default)
+    return any(l in permitted for l in levels)
+
 def I(access_hier, access_targets, access, **kwargs):
     """
     Consider obtaining a partial using convenience helper function `make_I`
@@ -27,7 +90,7 @@ def I(access_hier, access_targets, access, **kwargs):
      "writeable": set(["staff", "admin", "system"])}
     """
     # TODO: Properly document `I` function.
-    info = kwargs.copy()
+    info = PermissionInfo(access_hier, kwargs)
     info.update({"readable": set(), "writeable": set()})
 
     for name in access.split(","):
@@ -50,17 +113,113 @@ def I(access_hier, access_targets, access, **kwargs):
         for target in targets:
             info[access_targets[target]] |= levels
 
-    return info
+    return info.compile(set(access_targets.values()) | set(["readable", "writeable"]))
 
 def make_I(hier=DEFAULT_ACCESS_HIER, targets=DEFAULT_ACCESS_TARGETS):
     """
     Returns a partial that makes using `I` more convenient.
+
+    Permission specs are compiled to bitmasks over `hier`, so checking
+    whenever a level set is permitted costs a single bitwise AND.
     """
     return partial(I, hier, targets)
 
+def _permissions_cache():
+    """
+    Returns request-scoped permissions cache dict, or `None` when working
+    outside of request context.
+    """
+    if not has_request_context():
+        return None
+    cache = getattr(g, "toybox_permissions", None)
+    if cache is None:
+        cache = g.toybox_permissions = {}
+    return cache
+
+def _instance_cache_key(obj):
+    key_func = getattr(obj, "permissions_cache_key", None)
+    key = key_func() if key_func is not None else None
+    if key is None:
+        return None
+    return ("instance", key, getattr(g, "user", None))
+
+def instance_permissions(obj):
+    """
+    Returns a frozenset of access levels for `obj`, as returned by its
+    `check_instance_permissions` method.
+
+    Results are memoized for the duration of request, keyed on object's
+    `permissions_cache_key()` (if object has no such method or it returns
+    `None`, nothing is cached) and current user (`g.user`).
+    """
+    cache = _permissions_cache()
+    key = _instance_cache_key(obj) if cache is not None else None
+    if key is None:
+        return frozenset(obj.check_instance_permissions())
+    try:
+        return cache[key]
+    except KeyError:
+        levels = cache[key] = frozenset(obj.check_instance_permissions())
+        return levels
+
+def class_permissions(cls):
+    """
+    Returns a frozenset of access levels for model class `cls`, as returned
+    by its `check_class_permissions` method, memoized for the duration of
+    request and keyed on current user (`g.user`).
+    """
+    cache = _permissions_cache()
+    if cache is None:
+        return frozenset(cls.check_class_permissions())
+    key = ("class", cls, getattr(g, "user", None))
+    try:
+        return cache[key]
+    except KeyError:
+        levels = cache[key] = frozenset(cls.check_class_permissions())
+        return levels
+
+def prime_instance_permissions(model, objs):
+    """
+    If `model` has `check_instances_permissions` class method, calls it once
+    for all `objs` without memoized permissions, and memoizes the results.
+    The method must return a list of access levels sets, in the same order
+    as the passed objects.
+
+    Collection views call this once per page, so models could check
+    permissions in bulk (say, with a single SQL query).
+    """
+    bulk = getattr(model, "check_instances_permissions", None)
+    cache = _permissions_cache()
+    if bulk is None or cache is None:
+        return
+    keys = [(_instance_cache_key(obj), obj) for obj in objs]
+    missing = [(key, obj) for key, obj in keys
+               if key is not None and key not in cache]
+    if len(missing) == 0:
+        return
+    levels = bulk([obj for key, obj in missing])
+    for (key, obj), obj_levels in zip(missing, levels):
+        cache[key] = frozenset(obj_levels)
+
+def forget_instance_permissions(objs):
+    """
+    Drops memoized permissions of `objs`, so long streamed collections
+    don't keep an entry for every object until the request ends.
+    """
+    cache = _permissions_cache()
+    if cache is None:
+        return
+    for obj in objs:
+        key = _instance_cache_key(obj)
+        if key is not None:
+            cache.pop(key, None)
+
 class ModelColumnInfo(object):
     """
     Class that holds the information about model's column.
+
+    Note, `model` may be either a model instance or a model class, as column
+    information is usually shared between instances.
     """
     def __init__(self, model, name, db_column=True, permissions=None):
         self.model = model
@@ -9,10 +9,84 @@ In ToyBox, there are two concepts for this, called *serializers* and
 
 from __future__ import absolute_import
 import json
-from .compat import OrderedDict
+from .compat import OrderedDict, utc
+from .utils import is_iterator
+import calendar
+import datetime
 import decimal
+import operator
 
-class ExtendedJSONEncoder(json.JSONEncoder):
+_default_handlers = {}
+
+def _resolve_default_handler(cls):
+    """
+    Decides how instances of `cls` are represented by `ExtendedJSONEncoder`.
+    Returns a function that converts an instance to a JSON-encodable value,
+    or `None` if the class is not recognized.
+    """
+    if hasattr(cls, "as_dict"):
+        return operator.methodcaller("as_dict")
+    elif hasattr(cls, "as_list"):
+        return operator.methodcaller("as_list")
+    elif hasattr(cls, "isoformat"):
+        return operator.methodcaller("isoformat")
+    elif issubclass(cls, decimal.Decimal):
+        return str
+    return None
+
+def get_default_handler(obj):
+    """
+    Returns a function that converts `obj` to a value, that could be natively
+    represented by serialization formats (see `ExtendedJSONEncoder.default`),
+    or `None` if the object is not recognized.
+    """
+    cls = obj.__class__
+    try:
+        handler = _default_handlers[cls]
+    except KeyError:
+        handler = _default_handlers[cls] = _resolve_default_handler(cls)
+    if handler is not None:
+        return handler
+
+    # Instance attributes may still provide a representation.
+    if hasattr(obj, "as_dict"):
+        return operator.methodcaller("as_dict")
+    elif hasattr(obj, "as_list"):
+        return operator.methodcaller("as_list")
+    elif hasattr(obj, "isoformat"):
+        return operator.methodcaller("isoformat")
+    return None
+
+def as_document(obj):
+    """
+    Applies top-level rules (see `ExtendedJSONEncoder`) to an object,
+    that is about to be serialized as a document. Namedtuples are converted
+    to ordered dicts, other objects are returned as-is.
+    """
+    if isinstance(obj, tuple) and hasattr(obj, "_fields"):
+        return OrderedDict((k, v) for k, v in zip(obj._fields, obj))
+    return obj
+
+class ExtendedEncoderMixin(object):
+    """
+    Implementation of `ExtendedJSONEncoder` features, that could be mixed
+    into any `json.JSONEncoder`-compatible class.
+
+    Representation of non-native values is decided only once per class,
+    and is memoized in a dispatch table afterwards.
+    """
+    def encode(self, obj):
+        if hasattr(obj, "to_json"):
+            return obj.to_json()
+        return super(ExtendedEncoderMixin, self).encode(as_document(obj))
+
+    def default(self, obj):
+        handler = get_default_handler(obj)
+        if handler is not None:
+            return handler(obj)
+        return super(ExtendedEncoderMixin, self).default(obj) # pragma: no cover
+
+class ExtendedJSONEncoder(ExtendedEncoderMixin, json.JSONEncoder):
     """
     Extended JSON encoder, that may come useful when implementing web APIs.
 
@@ -45,27 +119,36 @@ class ExtendedJSONEncoder(json.JSONEncoder):
     '{"spam": "2012-01-01T00:00:00", "eggs": "42,42"}'
 
     """
-    def encode(self, obj):
-        if hasattr(obj, "to_json"):
-            return obj.to_json()
-        if isinstance(obj, tuple) and hasattr(obj, "_fields"):
-            obj = OrderedDict((k, v) for k, v in zip(obj._fields, obj))
-        return super(ExtendedJSONEncoder, self).encode(obj)
 
-    def default(self, obj):
-        if hasattr(obj, "as_dict"):
-            return obj.as_dict()
-        elif hasattr(obj, "as_list"):
-            return obj.as_list()
-        elif hasattr(obj, "isoformat"):
-            return obj.isoformat()
-        elif isinstance(obj, decimal.Decimal):
-            return str(obj)
-        return super(ExtendedJSONEncoder, self).default(obj) # pragma: no cover
+try:
+    import simplejson
+    from simplejson.encoder import c_make_encoder
+except ImportError: # pragma: no cover
+    simplejson = c_make_encoder = None
+
+if c_make_encoder is not None:
+    class ExtendedSimpleJSONEncoder(ExtendedEncoderMixin,
+                                    simplejson.JSONEncoder):
+        """
+        Same as `ExtendedJSONEncoder`, but based on `simplejson` with
+        C speedups. Options are set so the output is exactly the same.
+        """
+        def __init__(self, **kwargs):
+            kwargs.setdefault("use_decimal", False)
+            kwargs.setdefault("namedtuple_as_object", False)
+            kwargs.setdefault("allow_nan", True)
+            super(ExtendedSimpleJSONEncoder, self).__init__(**kwargs)
+else: # pragma: no cover
+    ExtendedSimpleJSONEncoder = None
 
 class JSON(object):
     """
     JSON serializer and deserializer.
+
+    Serialization is done using `encoder`, which is an instance of
+    `ExtendedSimpleJSONEncoder` if `simplejson` with C speedups is available,
+    or `ExtendedJSONEncoder` otherwise. Override it in a subclass to use
+    another backend.
     """
     mime_types = [
         "application/json",          # RFC4627, rest are compatibility
@@ -75,10 +158,210 @@ class JSON(object):
         "text/x-json",
     ]
 
-    @staticmethod
-    def serialize(data):
-        return json.dumps(data, cls=ExtendedJSONEncoder)
+    encoder = (ExtendedSimpleJSONEncoder or ExtendedJSONEncoder)()
+
+    @classmethod
+    def serialize(cls, data):
+        return cls.encoder.encode(data)
+
+    @classmethod
+    def serialize_iter(cls, items):
+        """
+        Serializes an iterable as a JSON array, yielding the result
+        item-by-item, so that whole array never resides in memory.
+
+        Items are encoded exactly the same way as list items are, so
+        the joined output is identical to `serialize(list(items))`.
+        """
+        encode = super(ExtendedEncoderMixin, cls.encoder).encode
+        separator = "["
+        for item in items:
+            yield separator + encode(item)
+            separator = ", "
+        yield "[]" if separator == "[" else "]"
 
     @staticmethod
     def deserialize(data):
         return json.loads(data) # pragma: no cover
+
+class NDJSON(object):
+    """
+    Newline-delimited JSON (also known as JSON Lines) serializer and
+    deserializer.
+
+    Lists and iterators are represented as one JSON document per line,
+    any other object is represented as a single line. This format is
+    always streamed, so views may produce rows as they're fetched,
+    without buffering the whole collection.
+
+    As deserialized data is always a list, it's not among the default
+    deserializers; add it to `DESERIALIZERS` of views that accept lists.
+    """
+    mime_types = [
+        "application/x-ndjson",
+        "application/jsonlines",
+        "application/x-jsonlines",
+    ]
+    streaming = True
+
+    @staticmethod
+    def _is_sequence(data):
+        return is_iterator(data) or (isinstance(data, (list, tuple))
+                                     and not hasattr(data, "_fields"))
+
+    @classmethod
+    def serialize(cls, data):
+        if cls._is_sequence(data):
+            return "".join(cls.serialize_iter(data))
+        return JSON.serialize(data) + "\n"
+
+    @staticmethod
+    def serialize_iter(items):
+        # Every line is a top-level document, so top-level rules apply.
+        encode = JSON.encoder.encode
+        for item in items:
+            yield encode(item) + "\n"
+
+    @staticmethod
+    def deserialize(data):
+        return [json.loads(line) for line in data.splitlines() if line.strip()]
+
+try:
+    import msgpack
+except ImportError: # pragma: no cover
+    msgpack = None
+
+try:
+    import cbor2
+except ImportError: # pragma: no cover
+    cbor2 = None
+
+# On Python 2, `str` is a byte string, but it almost always holds text,
+# which binary formats must encode as text, not as opaque bytes.
+_STR_IS_BYTES = str is bytes
+
+if _STR_IS_BYTES:
+    def _as_text(obj):
+        """
+        Recursively converts byte strings in dicts, lists and tuples to
+        unicode. Strings that aren't valid UTF-8 are left as bytes.
+        """
+        if isinstance(obj, str):
+            try:
+                return obj.decode("utf-8")
+            except UnicodeDecodeError:
+                return obj
+        elif isinstance(obj, dict) and not hasattr(obj, "as_dict"):
+            return OrderedDict((_as_text(k), _as_text(v)) for k, v in obj.items())
+        elif type(obj) in (list, tuple) or (isinstance(obj, tuple) and hasattr(obj, "_fields")):
+            return [_as_text(v) for v in obj]
+        return obj
+else: # pragma: no cover
+    def _as_text(obj):
+        return obj
+
+def _aware_datetime(value, timezone):
+    if value.tzinfo is None or value.utcoffset() is None:
+        value = value.replace(tzinfo=timezone)
+    return value
+
+if msgpack is not None:
+    class MessagePack(object):
+        """
+        MessagePack serializer and deserializer. Requires `msgpack` package.
+
+        Objects are represented using the same rules as `ExtendedJSONEncoder`
+        does, except for `to_json` which is JSON-specific. Datetimes are
+        represented using native timestamp extension type, when supported by
+        installed `msgpack` version. Naive datetimes are assumed to be in
+        `timezone` (UTC by default). Decimals are represented as strings.
+        """
+        mime_types = [
+            "application/msgpack",
+            "application/x-msgpack",
+            "application/vnd.msgpack",
+        ]
+        timezone = utc
+
+        @classmethod
+        def _default(cls, obj):
+            Timestamp = getattr(msgpack, "Timestamp", None)
+            if Timestamp is not None and isinstance(obj, datetime.datetime):
+                value = _aware_datetime(obj, cls.timezone)
+                return Timestamp(calendar.timegm(value.utctimetuple()),
+                                 value.microsecond * 1000)
+            handler = get_default_handler(obj)
+            if handler is None:
+                raise TypeError(repr(obj) + " is not MessagePack serializable")
+            return handler(obj)
+
+        @staticmethod
+        def _from_timestamp(value):
+            if isinstance(value, msgpack.Timestamp):
+                return (datetime.datetime(1970, 1, 1, tzinfo=utc)
+                        + datetime.timedelta(seconds=value.seconds,
+                                             microseconds=value.nanoseconds // 1000))
+            return value
+
+        @classmethod
+        def serialize(cls, data):
+            # Without `use_bin_type`, Python 2 strings are packed as text.
+            return msgpack.packb(as_document(data), default=cls._default,
+                                 use_bin_type=not _STR_IS_BYTES)
+
+        @classmethod
+        def deserialize(cls, data):
+            if not hasattr(msgpack, "Timestamp"): # pragma: no cover
+                return msgpack.unpackb(data, raw=False)
+            convert = cls._from_timestamp
+            return convert(msgpack.unpackb(
+                data, raw=False,
+                list_hook=lambda l: [convert(v) for v in l],
+                object_pairs_hook=lambda pairs: dict(
+                    (k, convert(v)) for k, v in pairs)))
+else: # pragma: no cover
+    MessagePack = None
+
+if cbor2 is not None:
+    class CBOR(object):
+        """
+        CBOR (RFC 7049) serializer and deserializer. Requires `cbor2` package.
+
+        Objects are represented using the same rules as `ExtendedJSONEncoder`
+        does, except for `to_json` which is JSON-specific. Datetimes and
+        decimals are represented using native CBOR tags. Naive datetimes are
+        assumed to be in `timezone` (UTC by default).
+
+        Iterators are serialized as indefinite-length arrays, so collections
+        could be streamed.
+        """
+        mime_types = [
+            "application/cbor",
+        ]
+        timezone = utc
+
+        @staticmethod
+        def _default(encoder, obj):
+            handler = get_default_handler(obj)
+            if handler is None:
+                raise TypeError(repr(obj) + " is not CBOR serializable")
+            encoder.encode(_as_text(handler(obj)))
+
+        @classmethod
+        def serialize(cls, data):
+            return cbor2.dumps(_as_text(as_document(data)), default=cls._default,
+                               timezone=cls.timezone)
+
+        @classmethod
+        def serialize_iter(cls, items):
+            yield b"\x9f"
+            for item in items:
+                yield cbor2.dumps(_as_text(item), default=cls._default,
+                                  timezone=cls.timezone)
+            yield b"\xff"
+
+        @staticmethod
+        def deserialize(data):
+            return cbor2.loads(data)
+else: # pragma: no cover
+    CBOR = None
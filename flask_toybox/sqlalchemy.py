@@ -12,25 +12,272 @@ Note, if PyYaml is installed, a SafeRepresenter as YAML hashmap is added.
 from __future__ import absolute_import
 
 from .compat import OrderedDict
-from sqlalchemy.orm import column_property, class_mapper, relationship, ColumnProperty, RelationshipProperty, object_session
+from sqlalchemy.orm import column_property, class_mapper, object_mapper, relationship, ColumnProperty, RelationshipProperty, object_session, defer, Mapper, Session
+from sqlalchemy import orm
 from sqlalchemy.orm.exc import NoResultFound
 from sqlalchemy.orm.collections import InstrumentedList
+from sqlalchemy.orm.attributes import instance_state
 from sqlalchemy.schema import Column
-from .views import ModelView, BaseModelView
-from .permissions import ModelColumnInfo
-from .utils import mixedmethod
-from flask import g, request
-from werkzeug.exceptions import InternalServerError, NotFound
+from sqlalchemy.types import Integer
+from sqlalchemy import event, and_, or_, func, bindparam, select
+from .views import ModelView, BaseModelView, append_vary
+from . import etags, caching
+from .exceptions import UnprocessableEntity
+from .permissions import ModelColumnInfo, instance_permissions, class_permissions, prime_instance_permissions, forget_instance_permissions, permits, levels_mask
+from .utils import mixedmethod, is_printable, LRUCache
+from flask import g, request, has_request_context, Response
+from werkzeug.exceptions import InternalServerError, NotFound, BadRequest, RequestedRangeNotSatisfiable
 from werkzeug.datastructures import Range, ContentRange
+from werkzeug.urls import url_encode
 import operator
 import json
-from copy import copy
+import base64
+
+try:
+    from sqlalchemy.ext import baked
+except ImportError: # pragma: no cover
+    baked = None
+
+# Caches of `SAModelMixin._get_columns` and `SAModelMixin._get_plan` results.
+# Cleared when mappers are (re)configured, as column properties may change.
+_columns_cache = {}
+_plans_cache = {}
+
+@event.listens_for(Mapper, "after_configured")
+def _clear_columns_cache():
+    _columns_cache.clear()
+    _plans_cache.clear()
 
 def column_info(model, name, column):
     return ModelColumnInfo(model, name,
                            db_column=isinstance(column, Column),
                            permissions=getattr(column, "info"))
 
+def _make_embedder(column):
+    """
+    Returns a function that prepares a relationship value for embedding
+    into parent's representation.
+    """
+    def embed(value):
+        if isinstance(value, SAModelMixin):
+            return Embedded(value, column)
+        elif isinstance(value, InstrumentedList):
+            return [Embedded(item, column)
+                    if isinstance(item, SAModelMixin) else item
+                    for item in value]
+        return value
+    return embed
+
+class Embedded(object):
+    """
+    Lightweight proxy, representing a model instance that is embedded into
+    another object's representation as `column`. Serializers see it as
+    an object with `as_dict` method, any other attribute access is passed
+    through to the wrapped instance.
+    """
+    __slots__ = ("obj", "column")
+
+    def __init__(self, obj, column):
+        self.obj = obj
+        self.column = column
+
+    def as_dict(self, check_permissions=True):
+        return self.obj.as_dict(check_permissions, embedded_as=self.column)
+
+    def __getattr__(self, name):
+        return getattr(self.obj, name)
+
+    def __repr__(self):
+        return repr(self.obj)
+
+class SerializationPlan(object):
+    """
+    Precompiled recipe for representing model instances as dicts, used by
+    `SAModelMixin.as_dict`. Plans are built once per model class, set of
+    access levels and embedding context, so all the decisions about what
+    to output are not repeated for every object.
+    """
+    def __init__(self, columns, embedded_as=None):
+        info = getattr(embedded_as, "permissions", None) or {}
+        if "embed_only" in info:
+            columns = [c for c in columns if c.name in info["embed_only"]]
+        self.has_rel = "embed_rel" in info
+        self.rel = info.get("embed_rel", None)
+        href = info.get("embed_href", None)
+        if href is not None and not callable(href):
+            href = href.format
+        self.href = href
+        self.steps = [(c.name, operator.attrgetter(c.name),
+                       _make_embedder(c) if not c.db_column else None)
+                      for c in columns]
+
+    def apply(self, obj, fields=None):
+        result = OrderedDict()
+        if self.has_rel:
+            result["rel"] = self.rel
+        if self.href is not None:
+            result["href"] = self.href(obj)
+        for name, getter, embed in self.steps:
+            if fields is not None and name not in fields:
+                continue
+            value = getter(obj)
+            if embed is not None:
+                value = embed(value)
+            result[name] = value
+        return result
+
+# Eager loading strategies, that could be specified using `embed_load` key
+# of relationship's info. Select IN loading requires SQLAlchemy 1.2+.
+LOADER_STRATEGIES = {
+    "joined": "joinedload",
+    "subquery": "subqueryload",
+    "selectin": "selectinload" if hasattr(orm, "selectinload") else "subqueryload",
+}
+
+def embedded_loader_paths(model, levels, fields=None, only=None,
+                          collections=True, _seen=()):
+    """
+    Walks relationships of `model`, that will be embedded into objects'
+    representation for given access `levels`, limited to `fields` (as
+    requested by client) and `only` (parent's `embed_only`).
+
+    Returns a list of paths, each being a list of `(strategy, attribute)`
+    tuples, suitable for building eager loading query options.
+
+    The strategy is taken from `embed_load` relationship info key, or is
+    `"joined"` for scalar and `"selectin"` for collection relationships.
+    Set `embed_load` to `False` to opt out. If `collections` is false,
+    only joined loads are used, and other relationships are skipped.
+    """
+    paths = []
+    mapper = class_mapper(model)
+    for c in model._get_columns(False, "readable", levels):
+        if c.db_column:
+            continue
+        if fields is not None and c.name not in fields:
+            continue
+        if only is not None and c.name not in only:
+            continue
+        prop = mapper.get_property(c.name)
+        if not isinstance(prop, RelationshipProperty) or prop in _seen:
+            continue
+        strategy = c.permissions.get("embed_load", None)
+        if strategy is False:
+            continue
+        if strategy is None:
+            strategy = "selectin" if prop.uselist else "joined"
+        if not collections and strategy != "joined":
+            continue
+
+        step = (strategy, getattr(model, c.name))
+        paths.append([step])
+        related = prop.mapper.class_
+        if issubclass(related, SAModelMixin):
+            for path in embedded_loader_paths(
+                    related, class_permissions(related),
+                    only=c.permissions.get("embed_only", None),
+                    collections=collections, _seen=_seen + (prop,)):
+                paths.append([step] + path)
+    return paths
+
+def loader_option(path):
+    """
+    Builds a query option from a path returned by `embedded_loader_paths`.
+    """
+    option = None
+    for strategy, attribute in path:
+        name = LOADER_STRATEGIES[strategy]
+        if option is None:
+            option = getattr(orm, name)(attribute)
+        else:
+            option = getattr(option, name)(attribute)
+    return option
+
+def model_tables(model):
+    """
+    Returns a frozenset of names of the tables `model` is mapped to, or its
+    relationships (recursively) are mapped to. Those are the tables the
+    model's representation may be loaded from.
+    """
+    key = (model, "tables")
+    try:
+        return _columns_cache[key]
+    except KeyError:
+        pass
+    tables, seen = set(), set()
+    mappers = [class_mapper(model)]
+    while mappers:
+        mapper = mappers.pop()
+        if mapper in seen:
+            continue
+        seen.add(mapper)
+        tables.update(t.fullname for t in mapper.tables)
+        mappers.extend(rel.mapper for rel in mapper.relationships)
+    tables = _columns_cache[key] = frozenset(tables)
+    return tables
+
+def _invalidate_tables(session, tables):
+    """
+    Invalidates result caches for `tables`, and remembers them so they're
+    invalidated again when `session` transaction ends.
+    """
+    if tables:
+        session.info.setdefault("toybox_tables", set()).update(tables)
+        caching.invalidate_all(tables)
+
+@event.listens_for(Session, "after_flush")
+def _invalidate_flushed(session, flush_context):
+    if not caching._caches:
+        return
+    tables = set()
+    for obj in list(session.new) + list(session.dirty) + list(session.deleted):
+        tables.update(t.fullname for t in object_mapper(obj).tables)
+    _invalidate_tables(session, tables)
+
+@event.listens_for(Session, "after_bulk_update")
+@event.listens_for(Session, "after_bulk_delete")
+def _invalidate_bulk(context):
+    table = getattr(context, "primary_table", None)
+    if caching._caches and table is not None:
+        _invalidate_tables(context.session, [table.fullname])
+
+@event.listens_for(Session, "after_commit")
+@event.listens_for(Session, "after_rollback")
+def _invalidate_finished(session):
+    # Results could be cached between flush and commit, while the changes
+    # were not visible to others yet.
+    tables = session.info.pop("toybox_tables", None)
+    if tables:
+        caching.invalidate_all(tables)
+
+def requested_fields():
+    """
+    Returns a set of field names, that client had requested for top-level
+    objects (see `SAModelViewBase.get_fields`), or `None` if there were no
+    such request and all fields are wanted.
+    """
+    if not has_request_context():
+        return None
+    return getattr(g, "toybox_fields", None)
+
+def _note_levels(model, levels):
+    """
+    Marks current response as specific to the caller, if an object of
+    `model` is output with access `levels`, that differ from class-level
+    ones, so the response is not cached (see `SAModelViewBase`).
+    """
+    if (has_request_context() and getattr(g, "toybox_shared", False)
+            and levels != class_permissions(model)):
+        g.toybox_shared = False
+
+def _inherits(cls, name):
+    """
+    Returns True if model class `cls` doesn't override `SAModelMixin`
+    method `name`.
+    """
+    method = getattr(cls, name, None)
+    return getattr(method, "__func__", method) is SAModelMixin.__dict__[name]
+
 class SAModelMixin(object):
     """
     SQLALchemy model mixin.
@@ -44,34 +291,87 @@ class SAModelMixin(object):
         permissions = column.permissions
         return permissions.get(what, frozenset(["system"]))
 
-    @mixedmethod
-    def get_columns(self, cls, only_db_columns=False, only_permitted=None):
-        # cls = self.__class__
-        columns = []
-        for prop in class_mapper(cls).iterate_properties:
-            if prop.key.startswith("_"):
-                continue
-            if isinstance(prop, ColumnProperty) and len(prop.columns) == 1:
-                if not only_db_columns or isinstance(prop.columns[0], Column):
-                    columns.append(column_info(self, prop.key, prop.columns[0]))
-            elif isinstance(prop, RelationshipProperty):
-                columns.append(column_info(self, prop.key, prop))
+    @classmethod
+    def _is_permitted(cls, column, what, levels):
+        """
+        Returns True if any of access `levels` has `what` permission on
+        `column`. Compiled bitmasks are used if column info was created with
+        `I`, otherwise the sets returned by `_get_permissions` are checked.
+        """
+        if getattr(column.permissions, "masks", None):
+            return permits(column.permissions, what, levels)
+        permitted = cls._get_permissions(column, what=what)
+        return any(l in permitted for l in levels)
 
-        if not only_db_columns:
-            # If there's a mix, "real" DB columns should go first
-            columns.sort(key=lambda c: c.db_column, reverse=True)
+    @classmethod
+    def _get_columns(cls, only_db_columns=False, only_permitted=None,
+                     levels=None):
+        """
+        Returns a tuple of class' columns, optionally only those permitted
+        for any of given access `levels`. Results are cached per class,
+        until mappers are reconfigured.
+        """
+        if only_permitted is not None:
+            levels = frozenset(levels)
+        key = (cls, only_db_columns, only_permitted, levels)
+        try:
+            return _columns_cache[key]
+        except KeyError:
+            pass
 
         if only_permitted is not None:
-            if self is not None:
-                levels = self.check_instance_permissions()
-            else:
-                levels = cls.check_class_permissions()
-            get_perms = cls._get_permissions
-            columns = [c for c in columns
-                       if any(l in get_perms(c, what=only_permitted)
-                              for l in levels)]
+            columns = tuple(c for c in cls._get_columns(only_db_columns)
+                            if cls._is_permitted(c, only_permitted, levels))
+        else:
+            columns = []
+            for prop in class_mapper(cls).iterate_properties:
+                if prop.key.startswith("_"):
+                    continue
+                if isinstance(prop, ColumnProperty) and len(prop.columns) == 1:
+                    if not only_db_columns or isinstance(prop.columns[0], Column):
+                        columns.append(column_info(cls, prop.key, prop.columns[0]))
+                elif isinstance(prop, RelationshipProperty):
+                    columns.append(column_info(cls, prop.key, prop))
+
+            if not only_db_columns:
+                # If there's a mix, "real" DB columns should go first
+                columns.sort(key=lambda c: c.db_column, reverse=True)
+            columns = tuple(columns)
+
+        _columns_cache[key] = columns
         return columns
 
+    @classmethod
+    def _get_plan(cls, levels=None, embedded_as=None):
+        """
+        Returns a cached `SerializationPlan` for objects of this class,
+        being serialized for given access `levels` (or without permission
+        checks, if `None`), possibly embedded as `embedded_as` column.
+        """
+        if levels is not None:
+            levels = frozenset(levels)
+        key = (cls, levels, embedded_as)
+        try:
+            return _plans_cache[key]
+        except KeyError:
+            pass
+        if levels is not None:
+            columns = cls._get_columns(False, "readable", levels)
+        else:
+            columns = cls._get_columns()
+        plan = _plans_cache[key] = SerializationPlan(columns, embedded_as)
+        return plan
+
+    @mixedmethod
+    def get_columns(self, cls, only_db_columns=False, only_permitted=None):
+        if only_permitted is None:
+            return list(cls._get_columns(only_db_columns))
+        if self is not None:
+            levels = instance_permissions(self)
+        else:
+            levels = class_permissions(cls)
+        return list(cls._get_columns(only_db_columns, only_permitted, levels))
+
     @classmethod
     def check_class_permissions(cls, **kwargs):
         return set(["system"])
@@ -79,38 +379,153 @@ class SAModelMixin(object):
     def check_instance_permissions(self, **kwargs):
         return self.check_class_permissions(**kwargs)
 
-    def as_dict(self, check_permissions=True):
-        check = "readable" if check_permissions else None
-        columns = self.get_columns(only_permitted=check)
-        result = OrderedDict()
-        if hasattr(self, "_embedded_as"):
-            parent_column = self._embedded_as
-            parent_info = getattr(parent_column, "permissions", {})
-            if "embed_only" in parent_info:
-                columns = [c for c in columns if c.name in parent_info["embed_only"]]
-            if "embed_rel" in parent_info:
-                result["rel"] = parent_info["embed_rel"]
-            if "embed_href" in parent_info:
-                f = parent_info["embed_href"]
-                if not callable(f):
-                    f = f.format
-                result["href"] = f(self)
-            # result["__embedded"] = {"as": parent_column.name}
-        for c in columns:
-            result[c.name] = getattr(self, c.name)
-            if isinstance(result[c.name], SAModelMixin):
-                result[c.name] = copy(result[c.name])
-                result[c.name]._embedded_as = c
-            elif isinstance(result[c.name], InstrumentedList):
-                l = []
-                for item in result[c.name]:
-                    if isinstance(item, SAModelMixin):
-                        item = copy(item)
-                        item._embedded_as = c
-                    l.append(item)
-                result[c.name] = l
+    # Names of columns `check_instances_permissions` (if model has one) reads
+    # from objects, besides the primary key. Unless declared, collections
+    # are never fetched with Core selects (see `SACollectionView`), as rows
+    # might lack them.
+    permissions_columns = None
+
+    etag_version_column = None
+
+    @classmethod
+    def _get_version_property(cls):
+        """
+        Returns the name of the property, that holds object's version for
+        ETags (see `etag_fingerprint`), or `None` if there's no such.
+        """
+        key = (cls, "version")
+        try:
+            return _columns_cache[key]
+        except KeyError:
+            pass
+        mapper = class_mapper(cls)
+        name = None
+        if mapper.version_id_col is not None:
+            name = mapper.get_property_by_column(mapper.version_id_col).key
+        elif (cls.etag_version_column is not None
+                and mapper.has_property(cls.etag_version_column)):
+            name = cls.etag_version_column
+        _columns_cache[key] = name
+        return name
+
+    def etag_fingerprint(self):
+        """
+        Returns a value, that changes whenever object's representation may
+        change, or `None` if that can't be told, and ETag has to be calculated
+        from the serialized representation.
+
+        Default implementation uses object's class, primary key and version,
+        taken from mapper's `version_id_col` or column named by
+        `etag_version_column` (unset by default), along with fingerprints
+        and access levels of embedded objects (levels decide which of their
+        fields are output). Override to use another source.
+
+        The version must change with every change of the object, so set
+        `etag_version_column` only to a column that's reliably updated
+        (a timestamp is a weak choice, as changes made within its
+        resolution are not noticed).
+        """
+        name = self._get_version_property()
+        key = instance_state(self).key
+        if name is None or key is None:
+            return None
+        embedded = []
+        for value in self._embedded_values():
+            if value is None:
+                embedded.append(None)
+                continue
+            fingerprint = getattr(value, "etag_fingerprint", None)
+            fingerprint = fingerprint() if fingerprint is not None else None
+            if fingerprint is None:
+                return None
+            embedded.append((fingerprint, tuple(sorted(instance_permissions(value)))))
+        return (self.__class__.__name__, tuple(key[1]), getattr(self, name),
+                tuple(embedded))
+
+    last_modified_column = None
+
+    @classmethod
+    def _get_last_modified_property(cls):
+        """
+        Returns the name of the column property named by
+        `last_modified_column`, or `None` if model has no such.
+        """
+        key = (cls, "last_modified")
+        try:
+            return _columns_cache[key]
+        except KeyError:
+            pass
+        mapper = class_mapper(cls)
+        name = cls.last_modified_column
+        if (name is None or not mapper.has_property(name)
+                or not isinstance(mapper.get_property(name), ColumnProperty)):
+            name = None
+        _columns_cache[key] = name
+        return name
+
+    def get_last_modified(self):
+        """
+        Returns the time object's representation was last modified at, that
+        is the latest of values of `last_modified_column` (unset by default)
+        of the object and the embedded objects. Returns `None` if that can't
+        be told (say, an embedded object has no such column).
+        """
+        name = self._get_last_modified_property()
+        if name is None:
+            return None
+        result = getattr(self, name)
+        for value in self._embedded_values():
+            if value is None:
+                continue
+            get_last_modified = getattr(value, "get_last_modified", None)
+            modified = get_last_modified() if get_last_modified is not None else None
+            if modified is None or result is None:
+                return None
+            result = max(result, modified)
         return result
 
+    def _embedded_values(self):
+        """
+        Yields requested embedded objects (`None` for missing ones).
+        """
+        fields = requested_fields()
+        for step, getter, embed in self._get_plan(instance_permissions(self)).steps:
+            if embed is None or (fields is not None and step not in fields):
+                continue
+            value = getter(self)
+            values = value if isinstance(value, InstrumentedList) else [value]
+            for value in values:
+                yield value
+
+    def permissions_cache_key(self):
+        """
+        Returns a key, identifying this object for the request-scoped
+        permissions cache (see `permissions.instance_permissions`), or `None`
+        if the object is not persistent yet and can't be identified.
+        """
+        return instance_state(self).key
+
+    def as_dict(self, check_permissions=True, fields=None, embedded_as=None):
+        """
+        Returns an ordered dict of object's columns values.
+
+        If `fields` are provided, only the columns with such names are
+        returned. If not, and the object is not embedded into another one,
+        fields requested by client (see `requested_fields`) are used.
+
+        Related objects are represented as `Embedded` proxies, that pass
+        the relationship column as `embedded_as` argument, which controls
+        `embed_only`, `embed_rel` and `embed_href` behavior.
+        """
+        if check_permissions:
+            levels = instance_permissions(self)
+            _note_levels(self.__class__, levels)
+        else:
+            levels = None
+        if fields is None and embedded_as is None:
+            fields = requested_fields()
+        return self._get_plan(levels, embedded_as).apply(self, fields)
+
     @staticmethod
     def yaml_safe_representer(dumper, data):
         return dumper.represent_mapping(
@@ -120,6 +535,8 @@ try:
     from yaml.representer import SafeRepresenter
     SafeRepresenter.add_multi_representer(
         SAModelMixin, SAModelMixin.yaml_safe_representer)
+    SafeRepresenter.add_representer(
+        Embedded, SAModelMixin.yaml_safe_representer)
     del SafeRepresenter
 except ImportError: # pragma: no cover
     pass
@@ -153,14 +570,369 @@ def hasUserMixin(owner_id_field):
                 if owner_id_field is not None:
                     if user.id == getattr(self, owner_id_field): p.add("owner")
             return p
+
+        @classmethod
+        def check_instances_permissions(cls, objs, user=None):
+            if user is None and hasattr(g, "user"):
+                user = g.user
+
+            class_levels = cls.check_class_permissions(user=user)
+            levels = []
+            for obj in objs:
+                p = set(class_levels)
+                if user is not None and owner_id_field is not None:
+                    if user.id == getattr(obj, owner_id_field): p.add("owner")
+                levels.append(p)
+            return levels
     return HasUserMixin
 
 class SAModelViewBase(object):
+    """
+    Base class for SQLAlchemy model views.
+
+    Clients may ask for a subset of fields using the query string parameter
+    named by `fields_param` (for example, `?fields=username,email`).
+    Columns that were not asked for are not loaded from the database.
+
+    Unless `prune_unreadable` is false, columns that aren't readable with
+    class-level permissions (see `check_class_permissions`) are not loaded
+    either. If instance-level permissions (like `owner`) grant access to
+    such column, it's loaded lazily, when the object is serialized.
+
+    If model has a `visible_to(levels, user)` class method, it's called with
+    class-level access levels and current user (`g.user`), and should return
+    an SQL clause that rows must satisfy to be visible (or `None` if every
+    row is). Rows that don't match are never fetched, so they're missing from
+    collections (and their counts) and single object views respond with 404.
+
+    Relationships, that will be embedded into the output, are loaded eagerly
+    (see `embedded_loader_paths`), unless `eager_load_embedded` is false.
+    Instance-level permissions are not known before the query is run, so
+    only relationships readable with class-level permissions are considered.
+
+    Set `bake_queries` to `True` to have queries built by `get_query` cached
+    using SQLAlchemy's baked queries extension (requires SQLAlchemy 1.0+).
+    Statements are then compiled only once per query shape (see
+    `get_query_shape`), and only parameter values are bound per request.
+    The query must depend only on things the shape describes, so if you
+    override `get_query`, extend `get_query_shape` accordingly. Queries
+    are never baked if model has a `visible_to` clause.
+
+    Set `result_cache` to a `caching.ResultCache` instance to have complete
+    serialized responses to GET requests cached (except for the streamed
+    ones), so repeated requests don't hit the database at all. Entries are
+    keyed by `get_cache_key` and tagged with the tables, returned by
+    `get_cache_tags`. Tables are invalidated when changes to them are
+    flushed or committed by any ORM session (including bulk updates and
+    deletes), but not when they're changed using Core statements or by
+    another application, so choose cache `ttl` accordingly. Responses
+    with objects whose instance-level permissions differ from class-level
+    ones (like `owner`) are specific to the caller, so they aren't cached.
+
+    Similarly, set `etag_index` to a `caching.ResultCache` to keep ETags of
+    GET responses, keyed and invalidated the same way. Conditional requests
+    are then answered with 304 (for matching `If-None-Match`) or 412 (for
+    not matching `If-Match`) before the database is queried. Use a cache
+    with a `caching.SharedMemoryCache` backend to share the index between
+    worker processes.
+
+    If model declares a modification time column (see
+    `SAModelMixin.last_modified_column`), responses have `Last-Modified`
+    header, and, if `validate_last_modified` is true, `If-Modified-Since`
+    and `If-Unmodified-Since` are checked before anything is serialized.
+    Set `last_modified` to `False` to disable this.
+    """
+    fields_param = "fields"
+    prune_unreadable = True
+    eager_load_embedded = True
+    bake_queries = False
+    _bakery = baked.bakery() if baked is not None else None
+    result_cache = None
+    etag_index = None
+    last_modified = True
+    validate_last_modified = True
+
     def __init__(self, *args, **kwargs):
         if not hasattr(self, "model") or len(args) > 0:
             raise InternalServerError("<p>Server entity misconfiguration.</p>")
         return super(SAModelViewBase, self).__init__(*args, **kwargs)
 
+    def dispatch_request(self, *args, **kwargs):
+        g.toybox_fields = self.get_fields()
+        self._cache_entry = self._etag_entry = None
+        g.toybox_shared = False
+        if self.result_cache is None and self.etag_index is None:
+            return super(SAModelViewBase, self).dispatch_request(*args, **kwargs)
+        g.toybox_shared = True
+
+        mime_type, serializer = self.negotiate_serializer(*args, **kwargs)
+        key = self.get_cache_key(mime_type, *args, **kwargs)
+        tags = self.get_cache_tags()
+        if self.etag_index is not None:
+            etag, versions = self.etag_index.lookup(key, tags)
+            if etag is not None:
+                # Raises `NotModified` or `PreconditionFailed` if possible.
+                etags.ETagger(request, None).set_etag(etag)
+            if request.method == "GET":
+                self._etag_entry = (key, versions)
+        if self.result_cache is not None and request.method == "GET":
+            cached, versions = self.result_cache.lookup(key, tags)
+            if cached is not None:
+                return self.make_cached_response(cached)
+            self._cache_entry = (key, versions)
+        return super(SAModelViewBase, self).dispatch_request(*args, **kwargs)
+
+    def get_cache_key(self, mime_type, *args, **kwargs):
+        """
+        Returns a key, identifying response to current request in
+        `result_cache`. It includes the view, its arguments, query string,
+        `Range` header, negotiated MIME type and class-level access levels
+        (as a bitmask, if they could be represented so). Responses that
+        depend on anything else (like instance-level permissions) are not
+        cached.
+        """
+        cls = self.__class__
+        levels = class_permissions(self.model)
+        mask = None
+        for c in self.model.get_columns():
+            hier = getattr(c.permissions, "hier", None)
+            if hier is not None:
+                mask = levels_mask(hier, levels)
+                break
+        return ("{0}.{1}".format(cls.__module__, cls.__name__),
+                tuple(sorted(kwargs.items())),
+                tuple(sorted(request.args.items(multi=True))),
+                request.headers.get("Range", None),
+                mime_type,
+                mask if mask is not None else tuple(sorted(levels)))
+
+    def get_cache_tags(self):
+        """
+        Returns names of the tables cached responses depend on.
+        """
+        return model_tables(self.model)
+
+    def make_cached_response(self, cached):
+        status, headers, data = cached
+        response = Response(data, status, headers)
+        etagger = etags.ETagger(request, None)
+        etag, weak = response.get_etag()
+        # Both raise `NotModified` if client has this response already.
+        if etag is not None:
+            etagger.set_etag(etag)
+        if response.last_modified is not None and self.validate_last_modified:
+            etagger.set_last_modified(response.last_modified)
+        append_vary(response, ["Accept", "Accept-Encoding"])
+        return self.finalize_response(response)
+
+    def finalize_response(self, response):
+        if not g.toybox_shared:
+            self._cache_entry = self._etag_entry = None
+        entry = getattr(self, "_cache_entry", None)
+        if (entry is not None and response.status_code in (200, 206)
+                and not response.is_streamed):
+            key, versions = entry
+            self.result_cache.store(key, (response.status, list(response.headers),
+                                          response.get_data()), versions)
+        entry = getattr(self, "_etag_entry", None)
+        if entry is not None and response.status_code in (200, 206):
+            etag, weak = response.get_etag()
+            if etag is not None and not weak:
+                key, versions = entry
+                self.etag_index.store(key, etag, versions)
+        return super(SAModelViewBase, self).finalize_response(response)
+
+    def get_fields(self):
+        """
+        Returns a set of field names requested by client, or `None` if all
+        fields were requested.
+
+        Raises `UnprocessableEntity` if there's no such field, or it's not
+        readable with any access level. Whenever fields are readable by the
+        client is checked later, with `check_fields`, once its access levels
+        are known.
+        """
+        if self.fields_param is None:
+            return None
+        value = request.args.get(self.fields_param, None)
+        if value is None:
+            return None
+
+        columns = self.model.get_columns()
+        readable = set(c.name for c in columns
+                       if self.model._get_permissions(c, what="readable"))
+        columns = set(c.name for c in columns)
+        fields = set()
+        for k in value.split(","):
+            k = k.strip()
+            if not k:
+                continue
+            name = '"{0}"'.format(k) if is_printable(k) else repr(k)
+            if k not in columns:
+                error = "<p>No such attribute: {0}</p>".format(name)
+                raise UnprocessableEntity(error)
+            if k not in readable:
+                error = "<p>Attribute {0} is not readable.</p>".format(name)
+                raise UnprocessableEntity(error)
+            fields.add(k)
+        return fields
+
+    def check_fields(self, fields, levels):
+        """
+        Raises `UnprocessableEntity`, listing requested `fields`, that aren't
+        readable with access `levels`, so clients don't get objects without
+        fields they've asked for.
+        """
+        if fields is None:
+            return
+        readable = set(c.name for c in self.model._get_columns(
+            False, "readable", levels))
+        rejected = sorted(fields - readable)
+        if rejected:
+            names = ", ".join('"{0}"'.format(k) for k in rejected)
+            error = "<p>Attributes are not readable: {0}</p>".format(names)
+            raise UnprocessableEntity(error)
+
+    def apply_fields(self, q):
+        """
+        Defers loading of database columns that client did not request, or
+        can't read according to class-level permissions. Primary and foreign
+        keys are always loaded, as they're required to identify objects and
+        load relationships, and so are the version column used for ETags and
+        the last modification time column.
+        """
+        fields = getattr(g, "toybox_fields", None)
+        if self.prune_unreadable:
+            readable = set(c.name for c in self.model.get_columns(
+                only_db_columns=True, only_permitted="readable"))
+            fields = readable if fields is None else fields & readable
+        if fields is None:
+            return q
+        version = getattr(self.model, "_get_version_property", None)
+        if version is not None:
+            fields = fields | set([version(), self.model._get_last_modified_property()])
+        options = []
+        for prop in class_mapper(self.model).iterate_properties:
+            if (prop.key in fields or not isinstance(prop, ColumnProperty)
+                    or len(prop.columns) != 1):
+                continue
+            column = prop.columns[0]
+            if (isinstance(column, Column)
+                    and not column.primary_key and not column.foreign_keys):
+                options.append(defer(prop.key))
+        return q.options(*options) if options else q
+
+    def set_last_modified(self, value):
+        """
+        Passes object's or collection's modification time to the request's
+        `ETagger`, if it's known. Raises `NotModified` if it's not newer than
+        `If-Modified-Since` request header (unless `validate_last_modified`
+        is false).
+        """
+        etagger = getattr(g, "etagger", None)
+        if self.last_modified and etagger is not None and value is not None:
+            etagger.set_last_modified(value, self.validate_last_modified)
+
+    def set_object_etag(self, obj):
+        """
+        Sets ETag for an object or a list of objects. If all of them have
+        fingerprints (see `SAModelMixin.etag_fingerprint`), ETag is derived
+        from those, caller's access levels and requested fields, so nothing
+        is serialized. Otherwise, ETag is calculated from the serialized
+        representation.
+
+        If view has `pagination_fingerprint` method (pagination mixins do),
+        its result is covered by the ETag too, as pagination headers may
+        change while the items stay the same.
+        """
+        etagger = getattr(g, "etagger", None)
+        if etagger is None:
+            return
+        pagination = (self.pagination_fingerprint()
+                      if hasattr(self, "pagination_fingerprint") else None)
+        fingerprints = []
+        for item in (obj if isinstance(obj, list) else [obj]):
+            fingerprint = getattr(item, "etag_fingerprint", None)
+            fingerprint = fingerprint() if fingerprint is not None else None
+            if fingerprint is None:
+                return etagger.set_object(obj, pagination)
+            levels = (instance_permissions(item)
+                      if hasattr(item, "check_instance_permissions") else ())
+            fingerprints.append((fingerprint, tuple(sorted(levels))))
+        fields = requested_fields()
+        etagger.set_fingerprint((
+            fingerprints if isinstance(obj, list) else fingerprints[0],
+            sorted(fields) if fields is not None else None,
+            pagination))
+
+    def filter_by_kwargs(self, q, kwargs):
+        """
+        Filters the query by equality to view arguments, like `filter_by`
+        does, but binds values as named parameters, so the statement does
+        not depend on them.
+        """
+        if len(kwargs) == 0:
+            return q
+        return q.filter(*[getattr(self.model, k) == bindparam("toybox_" + k)
+                          for k in kwargs]).params(self.kwargs_params(kwargs))
+
+    @staticmethod
+    def kwargs_params(kwargs):
+        return dict(("toybox_" + k, v) for k, v in kwargs.items())
+
+    def get_query_shape(self, *args, **kwargs):
+        """
+        Returns a tuple of a hashable key, identifying the statement that
+        `get_query` builds for current request regardless of parameter
+        values, and a dict of values for statement's bound parameters.
+        """
+        fields = getattr(g, "toybox_fields", None)
+        key = (tuple(sorted(kwargs)),
+               frozenset(fields) if fields is not None else None,
+               class_permissions(self.model),
+               hasattr(self, "is_streamed") and self.is_streamed())
+        return key, self.kwargs_params(kwargs)
+
+    def bake_query(self, *args, **kwargs):
+        """
+        Returns a `sqlalchemy.ext.baked.Result` for the query, that would be
+        returned by `get_query`, or `None` if queries are not baked.
+        """
+        if (not self.bake_queries or self._bakery is None
+                or hasattr(self.model, "visible_to")):
+            return None
+        key, params = self.get_query_shape(*args, **kwargs)
+        bq = self._bakery(lambda session: self.get_query(*args, **kwargs),
+                          self.__class__, key)
+        return bq(self.query_class(self.model).session).params(params)
+
+    def apply_visibility(self, q):
+        """
+        Filters the query with model's `visible_to` clause, if there's any.
+        """
+        visible_to = getattr(self.model, "visible_to", None)
+        if visible_to is None:
+            return q
+        clause = visible_to(class_permissions(self.model),
+                            getattr(g, "user", None))
+        return q.filter(clause) if clause is not None else q
+
+    def apply_eager_loading(self, q):
+        """
+        Adds eager loading options for embedded relationships to the query.
+        """
+        if not self.eager_load_embedded:
+            return q
+        streamed = hasattr(self, "is_streamed") and self.is_streamed()
+        paths = embedded_loader_paths(
+            self.model, class_permissions(self.model),
+            fields=getattr(g, "toybox_fields", None),
+            # Only joined loading is compatible with `yield_per`
+            collections=not streamed)
+        if not paths:
+            return q
+        return q.options(*[loader_option(path) for path in paths])
+
     def query_class(self, model):
         """
         Returns an object, that's API-compatible with `sqlalchemy.orm.query.Query`.
@@ -175,31 +947,335 @@ class SAModelViewBase(object):
 
 class SAModelView(SAModelViewBase, ModelView):
     def get_query(self, *args, **kwargs):
-        return self.query_class(self.model).filter_by(**kwargs)
+        q = self.filter_by_kwargs(self.query_class(self.model), kwargs)
+        q = self.apply_visibility(q)
+        return self.apply_eager_loading(self.apply_fields(q))
 
     def fetch_object(self, *args, **kwargs):
+        q = self.bake_query(*args, **kwargs)
+        if q is None:
+            q = self.get_query(*args, **kwargs)
         try:
-            obj = self.get_query(*args, **kwargs).one()
+            obj = q.one()
         except NoResultFound:
             raise NotFound()
-        if hasattr(g, "etagger"):
-            g.etagger.set_object(obj)
+        self.check_fields(requested_fields(), instance_permissions(obj))
+        if self.last_modified and hasattr(obj, "get_last_modified"):
+            self.set_last_modified(obj.get_last_modified())
+        self.set_object_etag(obj)
         return obj
 
 class SACollectionView(SAModelViewBase, BaseModelView):
+    """
+    A read-only view of SQLAlchemy model instances collection.
+
+    Set `stream` to `True` to have the collection streamed to the client
+    while the rows are fetched from the database in batches of
+    `stream_batch_size` items, so the memory usage stays flat regardless of
+    the collection size. Streamed responses don't have ETags, as those
+    would require the whole collection to be serialized in advance.
+
+    Collections are always streamed if negotiated serializer has a true
+    `streaming` attribute (for example, `NDJSON` serializer does).
+
+    Set `core_select` to `True` to skip creating model instances, and build
+    the output dicts straight from the rows of a Core `select()` over the
+    readable columns. This is only done when no relationships or other
+    non-column properties are going to be output (otherwise, the view falls
+    back to the ORM). As there are no instances, instance permissions are
+    taken from model's `check_instances_permissions` class method, that's
+    called with the rows (they have column values as attributes), or are
+    the class-level ones if there's no such method. If model overrides
+    `check_instance_permissions`, but has no `check_instances_permissions`,
+    class-level permissions can't be trusted, so the ORM is used too. Same
+    goes for models that don't declare `permissions_columns` for their
+    `check_instances_permissions`, and models that override `as_dict`.
+
+    Set `aggregate_etags` to `True` to have ETags of collections derived
+    from a single aggregate query (see `aggregate_fingerprint`), so
+    conditional requests are answered with 304 without loading any rows.
+    This requires model to have a version column (see
+    `SAModelMixin.etag_fingerprint`), and a single column primary key, and
+    is not done if any relationships are going to be output, as changes of
+    related objects wouldn't be noticed.
+
+    `Last-Modified` of collections is the latest modification time of their
+    items, so it doesn't change when items are removed (or shifted between
+    pages). Because of this, it's sent only as a hint, and conditional
+    requests are never answered using it (`validate_last_modified` is false).
+    """
+    validate_last_modified = False
+    stream = False
+    stream_batch_size = 100
+    core_select = False
+    aggregate_etags = False
+
+    def get_fields(self):
+        """
+        Same as `SAModelViewBase.get_fields`, but also checks fields against
+        class-level permissions, as those apply to the whole collection.
+        """
+        fields = super(SACollectionView, self).get_fields()
+        self.check_fields(fields, class_permissions(self.model))
+        return fields
+
     def get_query(self, *args, **kwargs):
-        q = self.query_class(self.model)
-        if len(kwargs) > 0:
-            q = q.filter_by(**kwargs)
-        return q
+        q = self.filter_by_kwargs(self.query_class(self.model), kwargs)
+        q = self.apply_visibility(q)
+        if self.uses_core():
+            return q.with_entities(*[getattr(self.model, name).label(name)
+                                     for name in self.get_core_columns()])
+        return self.apply_eager_loading(self.apply_fields(q))
+
+    def uses_core(self):
+        """
+        Returns True if collection is going to be fetched with a Core select.
+        """
+        return (self.core_select and self.has_row_permissions()
+                and _inherits(self.model, "as_dict")
+                and not self.outputs_relationships())
+
+    def outputs_relationships(self):
+        """
+        Returns True if any relationships or other non-column properties
+        may be output (as far as it can be told before the query is run).
+        """
+        fields = requested_fields()
+        for c in self.model.get_columns():
+            if (not c.db_column and (fields is None or c.name in fields)
+                    and self.model._get_permissions(c, what="readable")):
+                return True
+        return False
+
+    def has_row_permissions(self):
+        """
+        Returns True if permissions of Core rows could be told: either model
+        checks them in bulk with `check_instances_permissions`, and declares
+        `permissions_columns` it needs, or it doesn't override
+        `check_instance_permissions`, so they're class-level ones.
+        """
+        if hasattr(self.model, "check_instances_permissions"):
+            return self.model.permissions_columns is not None
+        return _inherits(self.model, "check_instance_permissions")
+
+    def get_core_columns(self):
+        """
+        Returns names of columns to select when `core_select` is used:
+        requested columns that are readable with any access level, and also
+        primary and foreign keys, keys used for pagination, if any, and
+        columns permissions are checked with (`permissions_columns`).
+        """
+        fields = requested_fields()
+        keys = set(self.get_key_columns() if hasattr(self, "get_key_columns") else [])
+        keys.update(self.model.permissions_columns or ())
+        keys.add(self.model._get_version_property())
+        keys.add(self.model._get_last_modified_property())
+        names = []
+        for c in self.model.get_columns(only_db_columns=True):
+            if not c.db_column:
+                continue
+            column = getattr(self.model, c.name).property.columns[0]
+            if (column.primary_key or column.foreign_keys or c.name in keys
+                    or ((fields is None or c.name in fields)
+                        and self.model._get_permissions(c, what="readable"))):
+                names.append(c.name)
+        return names
+
+    def _batches(self, objs):
+        """
+        Yields lists of at most `stream_batch_size` objects.
+        """
+        batch = []
+        for obj in objs:
+            batch.append(obj)
+            if len(batch) >= self.stream_batch_size:
+                yield batch
+                batch = []
+        if len(batch) > 0:
+            yield batch
+
+    def _prime_batches(self, objs):
+        """
+        Yields objects, priming permissions cache for every batch of them.
+        Memoized permissions are dropped once the batch is output, so the
+        cache doesn't grow with the collection.
+        """
+        for batch in self._batches(objs):
+            prime_instance_permissions(self.model, batch)
+            for item in batch:
+                yield item
+            forget_instance_permissions(batch)
+
+    def rows_as_dicts(self, rows):
+        """
+        Returns a list of dicts, representing Core `rows` as `as_dict` would
+        represent model instances with the same column values.
+        """
+        bulk = getattr(self.model, "check_instances_permissions", None)
+        if bulk is not None:
+            levels = [frozenset(l) for l in bulk(rows)]
+            for l in levels:
+                _note_levels(self.model, l)
+        else:
+            levels = [class_permissions(self.model)] * len(rows)
+        fields = requested_fields()
+        get_plan = self.model._get_plan
+        return [get_plan(l).apply(row, fields) for row, l in zip(rows, levels)]
+
+    def _core_batches(self, rows):
+        for batch in self._batches(rows):
+            for item in self.rows_as_dicts(batch):
+                yield item
+
+    def fetch_rows(self, q):
+        """
+        Runs a Core `select()` for the query built by `get_query` and
+        `limit_query`, and returns output dicts (or an iterator of them,
+        if the collection is streamed).
+        """
+        result = q.session.execute(q.statement)
+        if self.is_streamed():
+            rows = iter(result)
+            if hasattr(self, "limit_results"):
+                rows = self.limit_results(rows)
+            return self._core_batches(rows)
+        rows = result.fetchall()
+        if hasattr(self, "limit_results"):
+            rows = self.limit_results(rows)
+        objs = self.rows_as_dicts(list(rows))
+        if hasattr(g, "etagger") and not self._etag_aggregated:
+            g.etagger.set_object(objs)
+        return objs
+
+    def aggregate_fingerprint(self, q):
+        """
+        Returns a fingerprint of the collection, that would be returned by
+        the query `q`, computed by a single aggregate query. It consists of
+        number of rows, sum (for integer versions, as counters only grow)
+        or maximum (say, for timestamps) of their versions, and minimum,
+        maximum and sum of primary keys. If both primary keys and versions
+        are integers, sum of their products is added, so versions are tied
+        to the rows they belong to.
+
+        Returns `None` if the fingerprint can't be computed.
+        """
+        mapper = class_mapper(self.model)
+        version = getattr(self.model, "_get_version_property", lambda: None)()
+        if (version is None or len(mapper.primary_key) != 1
+                or self.outputs_relationships()):
+            return None
+        subquery = q.enable_eagerloads(False).statement.alias()
+        pk = subquery.corresponding_column(mapper.primary_key[0])
+        version = subquery.corresponding_column(
+            mapper.get_property(version).columns[0])
+        if pk is None or version is None:
+            return None
+        aggregate = func.sum if isinstance(version.type, Integer) else func.max
+        columns = [func.count(), aggregate(version), func.min(pk), func.max(pk)]
+        if isinstance(pk.type, Integer):
+            columns.append(func.sum(pk))
+            if isinstance(version.type, Integer):
+                columns.append(func.sum(pk * version))
+        row = q.session.execute(select(columns).select_from(subquery)).first()
+        return tuple(row)
+
+    def collection_last_modified(self, q):
+        """
+        Returns the maximum of `last_modified_column` values over the rows
+        the query `q` would return, or `None` if it can't be told: model has
+        no such column, or relationships are going to be output (their
+        changes wouldn't be noticed). Note, removal of rows isn't noticed
+        either, so this is only a hint, not a validator.
+        """
+        name = getattr(self.model, "_get_last_modified_property", lambda: None)()
+        if name is None or self.outputs_relationships():
+            return None
+        subquery = q.enable_eagerloads(False).statement.alias()
+        column = subquery.corresponding_column(
+            class_mapper(self.model).get_property(name).columns[0])
+        if column is None:
+            return None
+        return q.session.execute(
+            select([func.max(column)]).select_from(subquery)).scalar()
+
+    def set_aggregate_etag(self, q):
+        """
+        Sets ETag derived from `aggregate_fingerprint`, class-level access
+        levels, current user's `id`, requested fields and pagination headers,
+        if it's enabled and possible (pagination headers must be known before
+        the rows are fetched). Raises `NotModified` if ETag matches
+        `If-None-Match`.
+        """
+        self._etag_aggregated = False
+        etagger = getattr(g, "etagger", None)
+        if not self.aggregate_etags or etagger is None or self.is_streamed():
+            return
+        pagination = None
+        if hasattr(self, "pagination_fingerprint"):
+            pagination = self.pagination_fingerprint()
+            if pagination is None:
+                return
+        fingerprint = self.aggregate_fingerprint(q)
+        if fingerprint is None:
+            return
+        user = getattr(g, "user", None)
+        fields = requested_fields()
+        self._etag_aggregated = True
+        etagger.set_fingerprint((
+            "collection", self.model.__name__, fingerprint,
+            tuple(sorted(class_permissions(self.model))),
+            getattr(user, "id", None),
+            sorted(fields) if fields is not None else None,
+            pagination))
+
+    def is_streamed(self):
+        """
+        Returns True if collection is going to be streamed.
+        """
+        return self.stream or getattr(getattr(self, "serializer", None),
+                                      "streaming", False)
+
+    def bake_query(self, *args, **kwargs):
+        """
+        Paginated collections and Core selects are not baked. Streaming
+        requires SQLAlchemy 1.2+ to be baked.
+        """
+        if hasattr(self, "limit_query") or self.uses_core():
+            return None
+        result = super(SACollectionView, self).bake_query(*args, **kwargs)
+        if result is not None and self.is_streamed():
+            if not hasattr(result, "with_post_criteria"):
+                return None
+            batch_size = self.stream_batch_size
+            result = result.with_post_criteria(
+                lambda q: q.yield_per(batch_size))
+        return result
 
     def fetch_object(self, *args, **kwargs):
-        q = self.get_query(*args, **kwargs)
-        if hasattr(self, "limit_query"):
-            q = self.limit_query(q)
+        self._etag_aggregated = False
+        q = self.bake_query(*args, **kwargs)
+        if q is None:
+            q = self.get_query(*args, **kwargs)
+            if hasattr(self, "limit_query"):
+                q = self.limit_query(q)
+            self.set_aggregate_etag(q)
+            if self.last_modified and getattr(g, "etagger", None) is not None:
+                self.set_last_modified(self.collection_last_modified(q))
+            if self.uses_core():
+                return self.fetch_rows(q)
+            if self.is_streamed():
+                q = q.yield_per(self.stream_batch_size)
+        if self.is_streamed():
+            objs = iter(q)
+            if hasattr(self, "limit_results"):
+                objs = self.limit_results(objs)
+            return self._prime_batches(objs)
         objs = q.all()
-        if hasattr(g, "etagger"):
-            g.etagger.set_object(objs)
+        if hasattr(self, "limit_results"):
+            objs = self.limit_results(objs)
+        prime_instance_permissions(self.model, objs)
+        if not self._etag_aggregated:
+            self.set_object_etag(objs)
         return objs
 
 class QueryFiltering(object):
@@ -212,36 +1288,72 @@ class QueryFiltering(object):
 
     Note, filtering is allowed only on class-level readable fields, as returned
     by `check_class_permissions`. Other query arguments are silently ignored.
+    Filters only narrow down the query returned by parent's `get_query`, so
+    rows hidden by model's `visible_to` clause (applied by `SACollectionView`)
+    are never matched.
+
+    Filter values are bound as named parameters, and filter names and
+    operators are a part of the query shape, so filtered queries can be
+    baked (see `SAModelViewBase.bake_queries`).
     """
-    def decode_filter(self, name, value):
-        OPERATOR_MAP = {"eq:": operator.eq, "ne:": operator.ne,
-                        "lt:": operator.lt, "le:": operator.le,
-                        "gt:": operator.gt, "ge:": operator.ge}
+    OPERATOR_MAP = {"eq:": operator.eq, "ne:": operator.ne,
+                    "lt:": operator.lt, "le:": operator.le,
+                    "gt:": operator.gt, "ge:": operator.ge}
 
+    def decode_filter(self, name, value):
         op = operator.eq
-        if len(value) >= 3 and value[:3] in OPERATOR_MAP:
-            op, value = OPERATOR_MAP[value[:3]], value[3:]
+        if len(value) >= 3 and value[:3] in self.OPERATOR_MAP:
+            op, value = self.OPERATOR_MAP[value[:3]], value[3:]
         try:
             value = json.loads(value)
         except ValueError:
             pass
         return (op, value)
 
-    def get_query(self):
-        q = super(QueryFiltering, self).get_query()
-        columns = self.model.get_columns(only_permitted="readable")
-        columns = dict([(c.name, c) for c in columns])
+    def get_filters(self):
+        """
+        Returns a list of `(name, op, value)` tuples for the filters
+        requested in query string.
+        """
+        levels = class_permissions(self.model)
+        key = (self.model, "filterable", levels)
+        names = _columns_cache.get(key, None)
+        if names is None:
+            names = _columns_cache[key] = frozenset(
+                c.name for c in self.model._get_columns(False, "readable", levels))
 
+        filters = []
         for name, values in request.args.lists():
-            if name in columns:
-                c = getattr(self.model, name)
-                f = []
+            if name in names:
                 for value in values:
                     op, value = self.decode_filter(name, value)
                     if op is not None:
-                        f.append(op(c, value))
-                q = q.filter(*f)
-        return q
+                        filters.append((name, op, value))
+        return filters
+
+    def get_query_shape(self, *args, **kwargs):
+        key, params = super(QueryFiltering, self).get_query_shape(*args, **kwargs)
+        shape = []
+        for n, (name, op, value) in enumerate(self.get_filters()):
+            # Bound parameter type depends on value type, and comparisons
+            # with None are rendered as IS (NOT) NULL.
+            shape.append((name, op, type(value)))
+            if value is not None:
+                params["toybox_filter_{0:d}".format(n)] = value
+        return key + (tuple(shape),), params
+
+    def get_query(self, *args, **kwargs):
+        q = super(QueryFiltering, self).get_query(*args, **kwargs)
+        clauses, params = [], {}
+        for n, (name, op, value) in enumerate(self.get_filters()):
+            c = getattr(self.model, name)
+            if value is None:
+                clauses.append(op(c, None))
+            else:
+                param = "toybox_filter_{0:d}".format(n)
+                clauses.append(op(c, bindparam(param, value)))
+                params[param] = value
+        return q.filter(*clauses).params(params) if clauses else q
 
 class PaginableByNumber(object):
     """
@@ -257,15 +1369,55 @@ class PaginableByNumber(object):
 
     Set `order_by` to `False` if you do ordering by yourself, otherwise query
     will be automatically ordered on primary key(s).
+
+    Set `total_count` to include total number of items in `Content-Range`
+    response header. Possible values are:
+
+    - `"count"` - a separate `COUNT(*)` query, with ordering stripped.
+    - `"window"` - a `count(*) OVER ()` column in the same query. Requires
+      database support for window functions, and must not be used with
+      joined eager loading of collections, as it would multiply rows.
+    - `"estimate"` - a result of `estimate_count`, which is a cached
+      `COUNT(*)` that expires after `total_count_ttl` seconds.
     """
     max_limit = 50
     order_by = None
+    total_count = None
+    total_count_ttl = 60
+    _count_cache = LRUCache(max_size=1000)
 
     def __init__(self, *args, **kwargs):
         super(PaginableByNumber, self).__init__(*args, **kwargs)
         if self.order_by is None:
             order_by = [c for c in class_mapper(self.model).primary_key]
         self._content_range = None
+        self._total = None
+        self._count_query = None
+
+    def count_query(self, q):
+        """
+        Returns number of items in the query, ignoring its ordering.
+        """
+        return q.enable_eagerloads(False).order_by(None).count()
+
+    def estimate_count(self, q):
+        """
+        Returns approximate number of items in the query. Default
+        implementation caches `count_query` results for `total_count_ttl`
+        seconds. Override to use, for example, database statistics.
+        """
+        key = (self.__class__,
+               tuple(sorted((request.view_args or {}).items())),
+               tuple(sorted(request.args.items(multi=True))),
+               class_permissions(self.model))
+        if hasattr(self.model, "visible_to"):
+            # Visible rows may differ between users with same access levels
+            key += (getattr(g, "user", None),)
+        total = self._count_cache.get(key)
+        if total is None:
+            total = self.count_query(q)
+            self._count_cache.set(key, total, self.total_count_ttl)
+        return total
 
     def limit_query(self, q):
         # q = super(PaginableByNumber, self).limit_query(q)
@@ -279,29 +1431,72 @@ class PaginableByNumber(object):
         r = request.range
         if r is not None:
             if r.units != "items":
-                raise RequestedRangeNotSatisfiable("Unacceptable unit: '{0}'".format(r.units))
+                raise RequestedRangeNotSatisfiable(description="Unacceptable unit: '{0}'".format(r.units))
             if len(r.ranges) > 1:
-                raise RequestedRangeNotSatisfiable("Multiple ranges are not supported")
+                raise RequestedRangeNotSatisfiable(description="Multiple ranges are not supported")
             begin, end = r.ranges[0]
             if begin is None:
-                raise RequestedRangeNotSatisfiable("First item offset must be clearly specified")
+                raise RequestedRangeNotSatisfiable(description="First item offset must be clearly specified")
             limit = end - begin
             if limit < 1:
-                raise RequestedRangeNotSatisfiable("Invalid range")
+                raise RequestedRangeNotSatisfiable(description="Invalid range")
             elif self.max_limit is not None and limit > self.max_limit:
-                raise RequestedRangeNotSatisfiable("Won't return more than {0:d} items".format(self.max_limit))
+                raise RequestedRangeNotSatisfiable(description="Won't return more than {0:d} items".format(self.max_limit))
+            if self.total_count == "count":
+                self._total = self.count_query(q)
+            elif self.total_count == "estimate":
+                self._total = self.estimate_count(q)
+            elif self.total_count == "window":
+                self._count_query = q
+                q = q.add_columns(func.count().over())
+            elif self.total_count is not None:
+                raise ValueError("Unknown total_count: {0!r}".format(self.total_count))
             q = q.offset(begin)
             self._content_range = begin
         # XXX: While we're limiting anyway, according to HTTP spec we return 206 only if there was a Range header.
         q = q.limit(limit)
         return q
 
+    def pagination_fingerprint(self):
+        """
+        Returns the first item offset and total number of items, that are
+        sent in `Content-Range` header, or `None` if the total is not known
+        yet. Called after `limit_query`, for ETags.
+        """
+        if self._content_range is None:
+            return ()
+        if self._count_query is not None and self._total is None:
+            return None
+        return (self._content_range, self._total)
+
+    def limit_results(self, objs):
+        if self._count_query is None:
+            return objs
+        rows = list(objs)
+        if len(rows) > 0:
+            self._total = rows[0][len(rows[0]) - 1]
+        else:
+            # Nothing was returned, so the window had no rows to count.
+            self._total = self.count_query(self._count_query)
+        if hasattr(self, "uses_core") and self.uses_core():
+            # Core rows are flat, and the count is just an unused column.
+            return rows
+        return [row[0] for row in rows]
+
     def dehydrate(self, data):
         if self._content_range is not None:
+            if not hasattr(data, "__len__"):
+                # Pages are small, so it's fine to load them if streaming.
+                data = list(data)
             # Unfortunately, Range.make_content_range does not seem
             # to like units other than bytes, so it goes this way.
             begin = self._content_range
-            self._content_range = ContentRange("items", begin, begin + len(data))
+            if len(data) > 0:
+                self._content_range = ContentRange("items", begin, begin + len(data),
+                                                   self._total)
+            else:
+                # Empty range can't be represented, so only total is sent.
+                self._content_range = ContentRange("items", None, None, self._total)
         return data
 
     def handle_response(self, response):
@@ -310,3 +1505,158 @@ class PaginableByNumber(object):
             if isinstance(self._content_range, ContentRange):
                 response.headers.set("Content-Range", self._content_range)
         return response
+
+class PaginableByKey(object):
+    """
+    Mixin class, adding support for keyset (also known as cursor-based)
+    pagination. Append this class from the left (i.e.
+    `class Foo(PaginableByKey, ...)` to hook in.
+
+    Unlike `PaginableByNumber`, every page costs the same, regardless of how
+    deep it is, as long as ordering columns are indexed.
+
+    Collection is ordered on `key_columns` (names of columns, that must
+    uniquely identify an object and must not be nullable), or on primary
+    key(s) if it's `None`. Key values must be representable in JSON.
+
+    Clients get up to `limit` query parameter (or `max_limit`, whatever is
+    less) items. Links to next and previous pages are provided in `Link`
+    response header. Those links contain an opaque cursor, passed either
+    using `cursor` query parameter or `Range: cursor=...` header.
+    """
+    max_limit = 50
+    key_columns = None
+    cursor_param = "cursor"
+    limit_param = "limit"
+
+    def get_key_columns(self):
+        if self.key_columns is not None:
+            return list(self.key_columns)
+        mapper = class_mapper(self.model)
+        return [mapper.get_property_by_column(c).key
+                for c in mapper.primary_key]
+
+    @staticmethod
+    def encode_cursor(direction, values):
+        data = base64.urlsafe_b64encode(json.dumps([direction, values]))
+        return data.rstrip("=")
+
+    @staticmethod
+    def decode_cursor(cursor):
+        """
+        Returns a tuple of direction (`"next"` or `"prev"`) and key values.
+        Raises `ValueError` if cursor is invalid.
+        """
+        try:
+            data = base64.urlsafe_b64decode(str(cursor) + "=" * (-len(cursor) % 4))
+            direction, values = json.loads(data)
+        except (TypeError, ValueError, UnicodeError):
+            raise ValueError("Invalid cursor")
+        if direction not in ("next", "prev") or not isinstance(values, list):
+            raise ValueError("Invalid cursor")
+        return direction, values
+
+    def get_cursor(self):
+        """
+        Returns a tuple of direction and key values, requested by client,
+        or `None` if first page was requested.
+        """
+        cursor = request.args.get(self.cursor_param, None)
+        error = BadRequest
+        header = request.headers.get("Range", None)
+        if cursor is None and header is not None:
+            units, _, cursor = header.partition("=")
+            error = RequestedRangeNotSatisfiable
+            if units.strip() != "cursor":
+                raise error(description="Unacceptable unit: '{0}'".format(units.strip()))
+            cursor = cursor.strip()
+        if cursor is None:
+            return None
+        try:
+            direction, values = self.decode_cursor(cursor)
+        except ValueError:
+            raise error(description="Invalid cursor")
+        if len(values) != len(self.get_key_columns()):
+            raise error(description="Invalid cursor")
+        return direction, values
+
+    def get_limit(self):
+        limit = request.args.get(self.limit_param, None)
+        if limit is None:
+            return self.max_limit
+        try:
+            limit = int(limit)
+        except ValueError:
+            raise BadRequest("Invalid limit")
+        if limit < 1:
+            raise BadRequest("Invalid limit")
+        if self.max_limit is not None:
+            limit = min(limit, self.max_limit)
+        return limit
+
+    def limit_query(self, q):
+        columns = [getattr(self.model, name) for name in self.get_key_columns()]
+        cursor = self.get_cursor()
+        direction, values = cursor if cursor is not None else ("next", None)
+        self._cursor = cursor
+        self._limit = self.get_limit()
+
+        if direction == "next":
+            q = q.order_by(None).order_by(*[c.asc() for c in columns])
+            compare = operator.gt
+        else:
+            q = q.order_by(None).order_by(*[c.desc() for c in columns])
+            compare = operator.lt
+
+        if values is not None:
+            # (a, b) > (x, y) is expanded to (a > x) OR (a = x AND b > y),
+            # as not all databases support row values comparison.
+            clauses = []
+            for n, column in enumerate(columns):
+                equal = [c == v for c, v in zip(columns[:n], values[:n])]
+                clauses.append(and_(*(equal + [compare(column, values[n])])))
+            q = q.filter(or_(*clauses))
+
+        # One extra item tells whenever there are more items to fetch.
+        return q.limit(self._limit + 1)
+
+    def limit_results(self, objs):
+        objs = list(objs)
+        has_more = len(objs) > self._limit
+        objs = objs[:self._limit]
+        direction = self._cursor[0] if self._cursor is not None else "next"
+        if direction == "prev":
+            objs.reverse()
+
+        self._links = []
+        if len(objs) > 0:
+            names = self.get_key_columns()
+            key = lambda obj: [getattr(obj, name) for name in names]
+            if has_more or direction == "prev":
+                self._links.append(("next", self.make_page_url(
+                    self.encode_cursor("next", key(objs[-1])))))
+            if (has_more and direction == "prev") or (
+                    direction == "next" and self._cursor is not None):
+                self._links.append(("prev", self.make_page_url(
+                    self.encode_cursor("prev", key(objs[0])))))
+        return objs
+
+    def pagination_fingerprint(self):
+        """
+        Returns links to the adjacent pages, that are sent in `Link` header,
+        or `None` if they're not known yet (until the items are fetched).
+        """
+        links = getattr(self, "_links", None)
+        return tuple(links) if links is not None else None
+
+    def make_page_url(self, cursor):
+        args = request.args.copy()
+        args[self.cursor_param] = cursor
+        return request.base_url + "?" + url_encode(args)
+
+    def handle_response(self, response):
+        links = getattr(self, "_links", None)
+        if links:
+            response.headers.add("Link", ", ".join(
+                '<{0}>; rel="{1}"'.format(url, rel) for rel, url in links))
+        return response
\ No newline at end of file
@@ -1,5 +1,8 @@
 import string
+import threading
+import time
 from functools import partial
+from .compat import OrderedDict
 
 def is_printable(value):
     """
@@ -9,6 +12,60 @@ def is_printable(value):
     return isinstance(value, basestring) \
            and all(c in string.printable for c in value)
 
+def is_iterator(value):
+    """
+    Returns True if value is an iterator (like a generator), that could
+    be consumed only once. Returns False for lists, dicts, strings and
+    other containers.
+    """
+    try:
+        return iter(value) is value
+    except TypeError:
+        return False
+
+class LRUCache(object):
+    """
+    Simple thread-safe in-process cache, that holds up to `max_size` items,
+    evicting least recently used ones. If `ttl` (in seconds) is given,
+    items expire after that time.
+    """
+    def __init__(self, max_size=1000, ttl=None):
+        self.max_size = max_size
+        self.ttl = ttl
+        self._items = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, default=None):
+        with self._lock:
+            try:
+                expires, value = self._items.pop(key)
+            except KeyError:
+                return default
+            if expires is not None and expires < time.time():
+                return default
+            self._items[key] = (expires, value)
+            return value
+
+    def set(self, key, value, ttl=None):
+        ttl = ttl if ttl is not None else self.ttl
+        expires = time.time() + ttl if ttl is not None else None
+        with self._lock:
+            self._items.pop(key, None)
+            self._items[key] = (expires, value)
+            while len(self._items) > self.max_size:
+                self._items.popitem(last=False)
+
+    def delete(self, key):
+        with self._lock:
+            self._items.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._items.clear()
+
+    def __len__(self):
+        return len(self._items)
+
 # Taken from http://www.daniweb.com/software-development/python/code/406393/
 class mixedmethod(object):
     """
@@ -30,6 +87,14 @@ class mixedmethod(object):
     """
     def __init__(self, func):
         self.func = func
+        self._class_bound = {}
 
     def __get__(self, instance, cls):
-        return partial(self.func, instance, cls)
+        if instance is not None:
+            return partial(self.func, instance, cls)
+        # Class-level calls are always the same, so partials are reused.
+        try:
+            return self._class_bound[cls]
+        except KeyError:
+            bound = self._class_bound[cls] = partial(self.func, None, cls)
+            return bound
@@ -6,8 +6,10 @@ from __future__ import absolute_import
 from flask import Response, request, current_app, g
 from flask.views import MethodView
 import werkzeug.exceptions
-from . import exceptions, etags
-from .utils import is_printable
+from . import exceptions, etags, compression
+from .permissions import instance_permissions, permits
+from .compat import stream_with_context
+from .utils import is_printable, is_iterator
 from functools import wraps
 
 def append_vary(response, vary_on):
@@ -57,7 +59,19 @@ class NegotiatingMethodView(MethodView):
 
        If no content-type could be negotiated due to unacceptable `Accept`
        request header, an `NotAcceptable` exception is raised.
-       This negotiation happens *before* the request is handled.
+       This negotiation happens *before* the request is handled, and the
+       negotiated serializer is available to the view as `self.serializer`.
+
+       If the returned object is an iterator (say, a generator), and the
+       serializer has `serialize_iter` method, the response is streamed,
+       so the data never has to be fully loaded in memory. On Flask versions
+       without `stream_with_context` (before 0.9), the output is buffered
+       instead, as there would be no request context while streaming.
+
+       Streamed responses have no ETag, as it's known only after the body
+       is sent (and WSGI has no way to send trailers). If the view has
+       a true `etag_streamed` attribute, serialized output of GET requests
+       is buffered instead, and ETag is calculated as chunks are produced.
 
     Example::
 
@@ -79,6 +93,14 @@ class NegotiatingMethodView(MethodView):
 
     - `DESERIALIZERS` - an iterable (preferably, a set) of deserializer classes.
 
+    Responses are compressed according to `Accept-Encoding` request header.
+    See the `compression` module for details.
+
+    Set `cache_max_age` to a number of seconds to let clients and
+    intermediate caches reuse responses to GET requests for that long
+    (`Cache-Control: max-age`). Set `cache_private` to `True` if responses
+    are user-specific, so shared caches won't store them.
+
     """
     def negotiate_serializer(self, *args, **kwargs):
         """
@@ -107,6 +129,7 @@ class NegotiatingMethodView(MethodView):
                 request.method = method_override
 
         mime_type, serializer = self.negotiate_serializer(*args, **kwargs)
+        self.serializer = serializer
 
         # Deserialize the incoming request data (if any)
         deserializers = getattr(self, "DESERIALIZERS",
@@ -133,7 +156,8 @@ class NegotiatingMethodView(MethodView):
         request.decoded_data = decoded_data
 
         # Provide g.etag_object for ETags
-        g.etagger = etagger = etags.ETagger(request, serializer)
+        g.etagger = etagger = etags.ETagger(
+            request, serializer, current_app.config["TOYBOX_ETAG_ALGORITHM"])
 
         # Call parent.
         result = super(NegotiatingMethodView, self)\
@@ -152,16 +176,53 @@ class NegotiatingMethodView(MethodView):
             if hasattr(self, "dehydrate"):
                 result = self.dehydrate(result)
 
-            response = Response(serializer.serialize(result),
-                                status, headers, mimetype=mime_type)
+            # If `dehydrate` returned the object as-is, reuse the data that was
+            # serialized for ETag calculation, instead of doing it again.
+            data = etagger.get_serialized(result, serializer)
+            if data is None:
+                if is_iterator(result):
+                    if (not hasattr(serializer, "serialize_iter")
+                            or stream_with_context is None):
+                        data = serializer.serialize(list(result))
+                    elif (getattr(self, "etag_streamed", False)
+                            and request.method == "GET"
+                            and etagger.etag is None):
+                        data = etagger.set_chunks(
+                            serializer.serialize_iter(result))
+                    else:
+                        data = stream_with_context(
+                            serializer.serialize_iter(result))
+                else:
+                    data = serializer.serialize(result)
+            response = Response(data, status, headers, mimetype=mime_type)
             response.serialized_with = serializer
 
         append_vary(response, ["Accept", "Accept-Encoding"])
         # TODO: Move etagging to mixin injecting header using handle_response
         if etagger.etag is not None:
             response.set_etag(etagger.etag) 
+        if etagger.last_modified is not None:
+            response.last_modified = etagger.last_modified
+        if request.method == "GET" and getattr(self, "cache_max_age", None) is not None:
+            response.cache_control.max_age = self.cache_max_age
+            if getattr(self, "cache_private", False):
+                response.cache_control.private = True
         if hasattr(self, "handle_response"):
             response = self.handle_response(response)
+        return self.finalize_response(response)
+
+    def finalize_response(self, response):
+        """
+        Called with a complete response, right before it's returned. Default
+        implementation compresses it, if it's enabled and client accepts it.
+        """
+        config = current_app.config
+        if config["TOYBOX_COMPRESSION"]:
+            encoding = compression.negotiate_encoding(request.accept_encodings)
+            response = compression.compress_response(
+                response, encoding, config["TOYBOX_COMPRESSION_LEVEL"],
+                config["TOYBOX_COMPRESSION_MIN_SIZE"],
+                config["TOYBOX_COMPRESSION_FLUSH_SIZE"])
         return response
 
 class BaseModelView(NegotiatingMethodView):
@@ -207,7 +268,7 @@ class BaseModelView(NegotiatingMethodView):
         headers = {}
 
         if hasattr(obj, "check_instance_permissions"):
-            access = obj.check_instance_permissions()
+            access = instance_permissions(obj)
             if len(access) > 0 and access != frozenset(["system"]):
                 headers["X-Access-Classes"] = ", ".join(sorted(access))
 
@@ -229,13 +290,11 @@ class ModelView(BaseModelView):
         obj = self.get_object(**kwargs)
 
         if hasattr(obj, "check_instance_permissions"):
-            access = obj.check_instance_permissions()
-            columns = dict([(c.name, c.permissions.get("writeable", set()))
-                            for c in self.get_columns(only_db_columns=True)])
+            access = instance_permissions(obj)
         else:
-            access = frozenset(["system"])
-            columns = dict([(c.name, frozenset(["system"]))
-                            for c in self.get_columns(only_db_columns=True)])
+            access = None
+        columns = dict([(c.name, c.permissions)
+                        for c in self.get_columns(only_db_columns=True)])
 
         r = {}
         for k, v in request.decoded_data.items():
@@ -244,8 +303,9 @@ class ModelView(BaseModelView):
             if k not in columns:
                 error = "<p>No such attribute: {0}</p>".format(name)
                 raise exceptions.UnprocessableEntity(error)
-            if len(columns.get(k, set()) & access) > 0:
-                r[k] = v #, list(columns.get(k, set()) & access)
+            if access is None or permits(columns[k], "writeable", access,
+                                         default=frozenset()):
+                r[k] = v
             else:
                 error = "<p>Attribute {0} is not writeable.</p>".format(name)
                 raise exceptions.UnprocessableEntity(error)
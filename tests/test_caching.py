@@ -0,0 +1,62 @@
+import unittest
+
+from flask.ext.toybox.caching import ResultCache, SharedMemoryCache
+from flask.ext.toybox import caching
+import tempfile
+import shutil
+import os
+
+class SharedMemoryCacheTestCase(unittest.TestCase):
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.path)
+
+    def test_values(self):
+        cache = SharedMemoryCache(self.path)
+        value = ("200 OK", [("Content-Type", "application/json")], b"[]")
+        cache.set("spam", value)
+        self.assertEqual(SharedMemoryCache(self.path).get("spam"), value)
+        self.assertTrue(cache.get("eggs") is None)
+        cache.delete("spam")
+        self.assertEqual(cache.get("spam", "default"), "default")
+
+        # Only plain data could be stored
+        self.assertRaises(ValueError, cache.set, "spam", object())
+        self.assertEqual(os.listdir(self.path), [])
+
+    def test_expiration(self):
+        cache = SharedMemoryCache(self.path, ttl=-1)
+        cache.set("spam", "value")
+        cache.set("eggs", "value", 60)
+        self.assertTrue(cache.get("spam") is None)
+        self.assertEqual(cache.get("eggs"), "value")
+        self.assertEqual(len(os.listdir(self.path)), 1)
+
+    def test_pruning(self):
+        cache = SharedMemoryCache(self.path, max_entries=3, prune_every=6)
+        for n in range(5):
+            cache.set("key{0}".format(n), n, -1 if n == 4 else None)
+            os.utime(cache._filename("key{0}".format(n)), (n, n))
+        self.assertEqual(len(os.listdir(self.path)), 5)
+        # Sixth write prunes expired and then the oldest written values
+        cache.set("key5", 5)
+        self.assertEqual(len(os.listdir(self.path)), 3)
+        self.assertEqual([cache.get("key{0}".format(n)) for n in range(6)],
+                         [None, None, 2, 3, None, 5])
+
+    def test_private_directory(self):
+        os.chmod(self.path, 0o755)
+        self.assertRaises(ValueError, SharedMemoryCache, self.path)
+        path = os.path.join(self.path, "cache")
+        SharedMemoryCache(path)
+        self.assertEqual(os.stat(path).st_mode & 0o777, 0o700)
+
+    def test_result_cache(self):
+        cache = ResultCache(backend=SharedMemoryCache(self.path))
+        self.addCleanup(caching._caches.discard, cache)
+        value, versions = cache.lookup("key", ["table"])
+        self.assertTrue(value is None)
+        cache.store("key", ("200 OK", [], b"data"), versions)
+        self.assertEqual(cache.lookup("key", ["table"])[0], ("200 OK", [], b"data"))
+        cache.invalidate(["table"])
+        self.assertTrue(cache.lookup("key", ["table"])[0] is None)
@@ -0,0 +1,29 @@
+import unittest
+
+from flask.ext.toybox import compression
+from werkzeug.wrappers import Response
+import zlib
+
+class CompressionTestCase(unittest.TestCase):
+    def test_streamed_flush(self):
+        produced = []
+        def body():
+            for n in range(100):
+                produced.append(n)
+                yield '{{"n": {0}}}\n'.format(n)
+
+        response = Response(body())
+        compression.compress_response(response, "deflate", flush_size=64)
+        chunks = iter(response.response)
+
+        # Output is available long before the body is fully produced,
+        # and is decodable on its own
+        decompressor = zlib.decompressobj()
+        data = ""
+        while not data:
+            data = decompressor.decompress(next(chunks))
+        self.assertTrue(len(produced) < 10, produced)
+        self.assertEqual(data, "".join('{{"n": {0}}}\n'.format(n) for n in produced))
+
+        data += "".join(decompressor.decompress(chunk) for chunk in chunks)
+        self.assertEqual(data, "".join('{{"n": {0}}}\n'.format(n) for n in range(100)))
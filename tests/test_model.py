@@ -1,9 +1,11 @@
 import unittest
 
 from flask.ext.toybox.views import BaseModelView, ModelView
-from flask.ext.toybox.permissions import make_I, DEFAULT_ACCESS_HIER, ModelColumnInfo
+from flask.ext.toybox.permissions import make_I, DEFAULT_ACCESS_HIER, ModelColumnInfo, permits
+from flask.ext.toybox.serialization import JSON
 from flask.ext.toybox import ToyBox
 from flask import Flask, g
+from flask.ext.toybox.compat import OrderedDict
 import json
 
 DUMMY_DATA = {
@@ -40,6 +42,21 @@ class DummyModelView(ModelView):
         g.etagger.set_object(obj)
         return obj
 
+class CountingJSON(JSON):
+    calls = 0
+
+    @classmethod
+    def serialize(cls, data):
+        cls.calls += 1
+        return JSON.serialize(data)
+
+class CountingBaseModelView(DummyBaseModelView):
+    SERIALIZERS = OrderedDict([("application/json", CountingJSON)])
+
+class DehydratingBaseModelView(CountingBaseModelView):
+    def dehydrate(self, data):
+        return dict(data.as_dict(), dehydrated=True)
+
 class SimpleModelTestCase(unittest.TestCase):
     def setUp(self):
         app = Flask(__name__)
@@ -47,6 +64,8 @@ class SimpleModelTestCase(unittest.TestCase):
         toybox = ToyBox(app)
         app.add_url_rule("/test", view_func=DummyModelView.as_view("test"))
         app.add_url_rule("/test-base", view_func=DummyBaseModelView.as_view("test_base"))
+        app.add_url_rule("/test-counting", view_func=CountingBaseModelView.as_view("test_counting"))
+        app.add_url_rule("/test-dehydrating", view_func=DehydratingBaseModelView.as_view("test_dehydrating"))
         self.app = app.test_client()
 
     def test_permission_calc(self):
@@ -63,6 +82,20 @@ class SimpleModelTestCase(unittest.TestCase):
         ]
         self.assertEqual(DummyModel.permissions_test, reference)
 
+    def test_permission_masks(self):
+        rw, ro = DummyModel.permissions_test
+        self.assertTrue(permits(rw, "readable", ["owner"]))
+        self.assertTrue(permits(rw, "writeable", ["anonymous", "owner"]))
+        self.assertFalse(permits(rw, "readable", ["anonymous"]))
+        self.assertFalse(permits(ro, "writeable", DEFAULT_ACCESS_HIER))
+        # Levels outside of the hierarchy fall back to set lookups
+        self.assertFalse(permits(rw, "readable", ["nobody"]))
+        self.assertTrue(permits({"readable": set(["nobody"])},
+                                "readable", ["nobody"]))
+        # Bits follow positions in hierarchy
+        self.assertEqual(ro.masks["readable"], (1 << len(DEFAULT_ACCESS_HIER)) - 1)
+        self.assertEqual(ro.masks["writeable"], 0)
+
     def test_get(self):
         for url in ("/test", "/test-base"):
             response = self.app.get(url, headers={"Accept": "application/json"})
@@ -76,6 +109,20 @@ class SimpleModelTestCase(unittest.TestCase):
             })
             self.assertEqual(response.status_code, 304, response.data)
 
+    def test_serialize_once(self):
+        CountingJSON.calls = 0
+        response = self.app.get("/test-counting", headers={"Accept": "application/json"})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(json.loads(response.data), DUMMY_DATA)
+        self.assertEqual(CountingJSON.calls, 1)
+
+    def test_serialize_dehydrated(self):
+        CountingJSON.calls = 0
+        response = self.app.get("/test-dehydrating", headers={"Accept": "application/json"})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(json.loads(response.data), dict(DUMMY_DATA, dehydrated=True))
+        self.assertEqual(CountingJSON.calls, 2)
+
     def test_patch(self):
         response = self.app.get("/test", headers={"Accept": "application/json"})
         self.assertEqual(response.status_code, 200)
@@ -1,7 +1,7 @@
 import unittest
 
 from flask.ext.toybox.views import NegotiatingMethodView
-from flask.ext.toybox import ToyBox
+from flask.ext.toybox import ToyBox, serialization, etags
 from flask import Flask, request
 import json
 
@@ -14,11 +14,21 @@ class EchoView(NegotiatingMethodView):
         """Echoes back a received body."""
         return request.decoded_data
 
+class StreamingView(NegotiatingMethodView):
+    def get(self):
+        return (dict(n=n) for n in range(10))
+
+class BufferingView(StreamingView):
+    etag_streamed = True
+
 class NegotiationTestCase(unittest.TestCase):
     def setUp(self):
         app = Flask(__name__)
         toybox = ToyBox(app)
         app.add_url_rule("/echo", view_func=EchoView.as_view("echo"))
+        app.add_url_rule("/stream", view_func=StreamingView.as_view("stream"))
+        app.add_url_rule("/buffer", view_func=BufferingView.as_view("buffer"))
+        self.flask_app = app
         self.app = app.test_client()
 
     def test_unacceptable(self):
@@ -51,4 +61,55 @@ class NegotiationTestCase(unittest.TestCase):
             headers={"Accept": "application/json"}
         )
         self.assertEqual(response.status_code, 200, response.status)
-        self.assertEqual(json.loads(response.data), data)
\ No newline at end of file
+        self.assertEqual(json.loads(response.data), data)
+
+    def test_echo_post_binary(self):
+        data = {"eggs": "ev", "spam": [1, 2]}
+        for serializer in (serialization.MessagePack, serialization.CBOR):
+            if serializer is None:
+                continue
+            mime_type = serializer.mime_types[0]
+            response = self.app.post(
+                "/echo",
+                data=serializer.serialize(data),
+                content_type=mime_type,
+                headers={"Accept": mime_type}
+            )
+            self.assertEqual(response.status_code, 200, response.status)
+            self.assertEqual(response.mimetype, mime_type)
+            self.assertEqual(serializer.deserialize(response.data), data)
+
+    def test_set_raw(self):
+        items = [dict(n=n) for n in range(10)]
+        with self.flask_app.test_request_context("/"):
+            etagger = etags.ETagger(request, serialization.JSON)
+            etagger.set_raw(serialization.JSON.serialize(items), "json")
+            etag = etagger.etag
+            etagger.set_raw(serialization.JSON.serialize_iter(iter(items)), "json")
+            self.assertEqual(etagger.etag, etag)
+            etagger.set_raw(serialization.JSON.serialize(items[1:]), "json")
+            self.assertNotEqual(etagger.etag, etag)
+
+            for algorithm in ("sha1", "md5"):
+                etagger = etags.ETagger(request, serialization.JSON, algorithm)
+                etagger.set_raw("spam")
+                self.assertNotEqual(etagger.etag, etag)
+
+    def test_etag_streamed(self):
+        headers = {"Accept": "application/json"}
+        response = self.app.get("/stream", headers=headers)
+        self.assertTrue(response.is_streamed)
+        self.assertTrue(response.headers.get("ETag") is None)
+        body = response.data
+
+        response = self.app.get("/buffer", headers=headers)
+        self.assertEqual(response.data, body)
+        etag = response.headers.get("ETag")
+        with self.flask_app.test_request_context("/"):
+            etagger = etags.ETagger(request, serialization.JSON)
+            etagger.set_raw(body, "json")
+            self.assertEqual('"{0}"'.format(etagger.etag), etag)
+
+        headers["If-None-Match"] = etag
+        response = self.app.get("/buffer", headers=headers)
+        self.assertEqual(response.status_code, 304)
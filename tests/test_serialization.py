@@ -1,6 +1,7 @@
 import unittest
 
 from flask.ext.toybox import serialization
+from flask.ext.toybox.compat import utc
 import collections
 try:
     from collections import OrderedDict
@@ -63,3 +64,94 @@ class SerializationTestCase(unittest.TestCase):
                      '"normal": [{"k": "v"}, 123]}')
 
         self.assertEqual(serialized, reference)
+
+    def test_json_encoders_match(self):
+        if serialization.ExtendedSimpleJSONEncoder is None:
+            self.skipTest("simplejson with C speedups is not available")
+        data = OrderedDict([
+            ("namedtuple", SpamTuple(u"\u0441\u043f\u0430\u043c", 1.5)),
+            ("decimal", decimal.Decimal("4242.42424242424242424242")),
+            ("as_dict", [SpamDict({"spam": datetime.date(2012, 1, 1)})]),
+            ("normal", [{"k": None, 1: True}, (1, 2), 123, -0.1]),
+            ("special", [float("nan"), float("inf"), float("-inf")]),
+        ])
+        for obj in (data, SpamTuple(data, None), SpamJSON("42")):
+            self.assertEqual(
+                serialization.ExtendedSimpleJSONEncoder().encode(obj),
+                serialization.ExtendedJSONEncoder().encode(obj))
+
+    def test_json_serialize_iter(self):
+        items = [SpamTuple("spam_value", "eggs_value"),
+                 SpamDict({"spam": "spam_value"}),
+                 datetime.datetime(2012, 1, 1, 0, 0, 0, 0)]
+        for data in ([], items[:1], items):
+            serialized = "".join(serialization.JSON.serialize_iter(iter(data)))
+            self.assertEqual(serialized, serialization.JSON.serialize(data))
+
+    def test_ndjson(self):
+        items = [SpamTuple("spam_value", "eggs_value"), {"spam": [1, 2]}]
+        serialized = serialization.NDJSON.serialize(items)
+        reference = ('{"spam": "spam_value", "eggs": "eggs_value"}\n'
+                     '{"spam": [1, 2]}\n')
+        self.assertEqual(serialized, reference)
+        self.assertEqual(serialized, "".join(serialization.NDJSON.serialize_iter(iter(items))))
+        self.assertEqual(serialization.NDJSON.serialize(items[0]),
+                         '{"spam": "spam_value", "eggs": "eggs_value"}\n')
+        self.assertEqual(serialization.NDJSON.deserialize(serialized),
+                         [{"spam": "spam_value", "eggs": "eggs_value"}, {"spam": [1, 2]}])
+
+    def test_msgpack(self):
+        if serialization.MessagePack is None:
+            self.skipTest("msgpack is not available")
+        data = OrderedDict([
+            ("datetime", datetime.datetime(2012, 1, 1, 0, 0, 0, 500)),
+            ("decimal", decimal.Decimal("4242.42424242424242424242")),
+            ("as_dict", SpamDict({"spam": "spam_value"})),
+            ("normal", [{"k": "v"}, 123]),
+        ])
+        MessagePack = serialization.MessagePack
+        import msgpack
+        if hasattr(msgpack, "Timestamp"):
+            expected_datetime = datetime.datetime(2012, 1, 1, 0, 0, 0, 500, tzinfo=utc)
+        else:
+            # Older versions have no timestamp type, so ISO strings are used.
+            expected_datetime = serialization.get_default_handler(data["datetime"])(data["datetime"])
+        self.assertEqual(MessagePack.deserialize(MessagePack.serialize(data)), {
+            "datetime": expected_datetime,
+            "decimal": "4242.42424242424242424242",
+            "as_dict": {"spam": "spam_value"},
+            "normal": [{"k": "v"}, 123],
+        })
+        self.assertEqual(MessagePack.deserialize(MessagePack.serialize(
+            SpamTuple("spam_value", "eggs_value"))),
+            {"spam": "spam_value", "eggs": "eggs_value"})
+        # Strings are encoded as text (fixstr), not as binary data
+        self.assertEqual(MessagePack.serialize({"k": "v"}), b"\x81\xa1k\xa1v")
+        self.assertEqual(MessagePack.serialize({u"k": u"v"}), b"\x81\xa1k\xa1v")
+
+    def test_cbor(self):
+        if serialization.CBOR is None:
+            self.skipTest("cbor2 is not available")
+        data = OrderedDict([
+            ("datetime", datetime.datetime(2012, 1, 1, 0, 0, 0, 500)),
+            ("date", datetime.date(2012, 1, 1)),
+            ("decimal", decimal.Decimal("4242.42424242424242424242")),
+            ("as_list", SpamList((1, 2, 3))),
+            ("namedtuple", SpamTuple(1, 2)),
+        ])
+        CBOR = serialization.CBOR
+        reference = {
+            "datetime": datetime.datetime(2012, 1, 1, 0, 0, 0, 500, tzinfo=utc),
+            "date": "2012-01-01",
+            "decimal": decimal.Decimal("4242.42424242424242424242"),
+            "as_list": [1, 2, 3],
+            "namedtuple": [1, 2],
+        }
+        self.assertEqual(CBOR.deserialize(CBOR.serialize(data)), reference)
+        streamed = b"".join(CBOR.serialize_iter(iter([data, None])))
+        self.assertEqual(CBOR.deserialize(streamed), [reference, None])
+        # Strings are encoded as text (major type 3), not as byte strings
+        self.assertEqual(CBOR.serialize({"k": "v"}), b"\xa1\x61k\x61v")
+        self.assertEqual(CBOR.serialize({u"k": u"v"}), b"\xa1\x61k\x61v")
+        self.assertEqual(CBOR.serialize(SpamList(["v"])), b"\x81\x61v")
+        self.assertEqual(b"".join(CBOR.serialize_iter(iter(["v"]))), b"\x9f\x61v\xff")
@@ -1,14 +1,27 @@
 import unittest
 
-from flask.ext.toybox.sqlalchemy import SAModelMixin, SAModelView, SACollectionView, PaginableByNumber, QueryFiltering
+from flask.ext.toybox.sqlalchemy import SAModelMixin, SAModelView, SACollectionView, PaginableByNumber, PaginableByKey, QueryFiltering
 from flask.ext.toybox.permissions import make_I
-from flask.ext.toybox import ToyBox
+from flask.ext.toybox.caching import ResultCache, SharedMemoryCache
+from flask.ext.toybox import caching
+from flask.ext.toybox import ToyBox, views
 from flask import Flask, g, request
-from sqlalchemy import create_engine
-from sqlalchemy.orm import sessionmaker, scoped_session, Session, relationship
+from sqlalchemy import create_engine, event
+from sqlalchemy.orm import sessionmaker, scoped_session, Session, relationship, Query
 from sqlalchemy.ext.declarative import declarative_base
-from sqlalchemy import Column, Integer, String, Boolean, ForeignKey
+from sqlalchemy import Column, Integer, String, Boolean, DateTime, ForeignKey
+from flask.ext.toybox.serialization import JSON
+from datetime import datetime, timedelta
+from werkzeug.http import http_date
 import json
+import urlparse
+import tempfile
+import shutil
+
+try:
+    from sqlalchemy.ext import baked
+except ImportError:
+    baked = None
 
 Base = declarative_base()
 I = make_I()
@@ -58,14 +71,72 @@ class User(Base, SAModelMixin):
         else:
             return set(["anonymous"])
 
+    @classmethod
+    def check_instances_permissions(cls, objs):
+        auth = request.args.get("auth", "")
+        if auth != "" and len(objs) > 0:
+            # Objects may be Core rows, that don't belong to a session
+            user = cls.session.query(User).filter_by(username=auth).one()
+            return [set(["owner"]) if user.id == obj.id else set(["authenticated"]) for obj in objs]
+        else:
+            return [set(["anonymous"]) for obj in objs]
+
+    # Only the primary key is used above
+    permissions_columns = ()
+
     def __repr__(self):
         return "<{0}: {1}, {2}>".format(self.__class__.__name__,
                                         self.username, self.fullname)
 
+class VersionedCompany(Base, SAModelMixin):
+    __tablename__ = "test_versioned_companies"
+
+    id = Column(Integer, primary_key=True)
+    name = Column(String, info=I("r:all,w:admin+"))
+    updated_at = Column(DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
+    etag_version_column = "updated_at"
+    last_modified_column = "updated_at"
+
+    def __init__(self, name):
+        self.name = name
+
+    def check_instance_permissions(self, user=None):
+        return set(["authenticated"]) if request.args.get("auth", "") != "" else set(["anonymous"])
+
+class VersionedUser(Base, SAModelMixin):
+    __tablename__ = "test_versioned_users"
+
+    id = Column(Integer, primary_key=True)
+    username = Column(String, info=I("r:all,w:none"))
+    fullname = Column(String, info=I("rw:all"))
+    email = Column(String, info=I("rw:owner+"))
+    badges = Column(Integer, default=0, info=I("r:all,w:staff+"))
+    company_id = Column(Integer, ForeignKey(VersionedCompany.id), info=I("rw:none"))
+    company = relationship("VersionedCompany", info=I("r:all,w:none", embed_only=["name"], embed_href="/versioned-companies/{0.id}"))
+    version = Column(Integer, nullable=False)
+
+    __mapper_args__ = {"version_id_col": version}
+
+    def __init__(self, username, fullname, email, **kwargs):
+        self.username = username
+        self.fullname = fullname
+        self.email = email
+        for name, value in kwargs.items():
+            setattr(self, name, value)
+
+    def check_instance_permissions(self, user=None):
+        auth = request.args.get("auth", "")
+        if auth != "":
+            user = Session.object_session(self).query(VersionedUser).filter_by(username=auth).one()
+            return set(["owner"]) if user.id == self.id else set(["authenticated"])
+        else:
+            return set(["anonymous"])
+
 class SQLAlchemyModelTestCase(unittest.TestCase):
     def setUp(self):
         # Set up SQLAlchemy models
         engine = create_engine('sqlite:///:memory:', echo=False)
+        self.engine = engine
         Base.metadata.create_all(engine)
         ScopedSession = scoped_session(sessionmaker(bind=engine))
 
@@ -77,8 +148,14 @@ class SQLAlchemyModelTestCase(unittest.TestCase):
         db_session.add(User("spam", "Spam", "spam@users.example.org", badges=1, is_staff=True, company=companies[0]))
         db_session.add(User("ham", "Ham", "ham@users.example.org", is_active=False, company=companies[1]))
         db_session.add(User("eggs", "Eggs", "eggs@users.example.org", badges=2, is_staff=True))
+        # Same data for models with versions and modification times
+        companies = [VersionedCompany("The Spanish Inquisition"), VersionedCompany("The Vikings")]
+        db_session.add(VersionedUser("spam", "Spam", "spam@users.example.org", badges=1, company=companies[0]))
+        db_session.add(VersionedUser("ham", "Ham", "ham@users.example.org", company=companies[1]))
+        db_session.add(VersionedUser("eggs", "Eggs", "eggs@users.example.org", badges=2))
         db_session.commit()
         self.db_session = db_session
+        User.session = db_session
 
         # Set up Flask
         app = Flask(__name__)
@@ -105,6 +182,118 @@ class SQLAlchemyModelTestCase(unittest.TestCase):
             order_by = "username"
         app.add_url_rule("/users/", view_func=UsersView.as_view("users"))
 
+        for total_count in ("count", "window", "estimate"):
+            class CountedUsersView(PaginableByNumber, QueryFiltering, SACollectionView):
+                model = User
+                query_class = db_session.query
+                order_by = "username"
+            CountedUsersView.total_count = total_count
+            app.add_url_rule("/users-" + total_count + "/",
+                             view_func=CountedUsersView.as_view("users_" + total_count))
+
+        class StreamingUsersView(QueryFiltering, SACollectionView):
+            model = User
+            query_class = db_session.query
+            stream = True
+            stream_batch_size = 2
+        app.add_url_rule("/users-stream/", view_func=StreamingUsersView.as_view("users_stream"))
+
+        class UsersByKeyView(PaginableByKey, QueryFiltering, SACollectionView):
+            model = User
+            query_class = db_session.query
+            key_columns = ("username",)
+            max_limit = 2
+        app.add_url_rule("/users-by-key/", view_func=UsersByKeyView.as_view("users_by_key"))
+
+        class LazyUsersView(SACollectionView):
+            model = User
+            query_class = db_session.query
+            eager_load_embedded = False
+        app.add_url_rule("/users-lazy/", view_func=LazyUsersView.as_view("users_lazy"))
+
+        class BakedUserView(SAModelView):
+            model = User
+            query_class = db_session.query
+            bake_queries = True
+        app.add_url_rule("/users-baked/<username>", view_func=BakedUserView.as_view("user_baked"))
+
+        class BakedUsersView(QueryFiltering, SACollectionView):
+            model = User
+            query_class = db_session.query
+            bake_queries = True
+        app.add_url_rule("/users-baked/", view_func=BakedUsersView.as_view("users_baked"))
+
+        class CachedUsersView(PaginableByNumber, QueryFiltering, SACollectionView):
+            model = User
+            query_class = db_session.query
+            order_by = "username"
+            result_cache = ResultCache(max_size=10)
+        app.add_url_rule("/users-cached/", view_func=CachedUsersView.as_view("users_cached"))
+
+        class VersionedUserView(SAModelView):
+            model = VersionedUser
+            query_class = db_session.query
+        app.add_url_rule("/versioned-users/<username>", view_func=VersionedUserView.as_view("versioned_user"))
+
+        class VersionedCompanyView(SAModelView):
+            model = VersionedCompany
+            query_class = db_session.query
+            cache_max_age = 60
+        app.add_url_rule("/versioned-companies/<int:id>", view_func=VersionedCompanyView.as_view("versioned_company"))
+
+        class VersionedCompaniesView(SACollectionView):
+            model = VersionedCompany
+            query_class = db_session.query
+            cache_max_age = 60
+            cache_private = True
+        app.add_url_rule("/versioned-companies/", view_func=VersionedCompaniesView.as_view("versioned_companies"))
+
+        class IndexedUserView(UserView):
+            etag_index = ResultCache()
+        app.add_url_rule("/users-indexed/<username>", view_func=IndexedUserView.as_view("user_indexed"))
+
+        shm_path = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, shm_path)
+        shared_index = ResultCache(backend=SharedMemoryCache(shm_path))
+        self.addCleanup(caching._caches.discard, shared_index)
+        class SharedIndexedUsersView(PaginableByNumber, QueryFiltering, SACollectionView):
+            model = User
+            query_class = db_session.query
+            order_by = "username"
+            etag_index = shared_index
+        app.add_url_rule("/users-indexed/", view_func=SharedIndexedUsersView.as_view("users_indexed"))
+
+        class AggregateETagUsersView(PaginableByNumber, QueryFiltering, SACollectionView):
+            model = VersionedUser
+            query_class = db_session.query
+            order_by = "username"
+            aggregate_etags = True
+        app.add_url_rule("/versioned-users/", view_func=AggregateETagUsersView.as_view("versioned_users"))
+
+        class CoreUsersView(PaginableByNumber, QueryFiltering, SACollectionView):
+            model = User
+            query_class = db_session.query
+            order_by = "username"
+            total_count = "window"
+            core_select = True
+        app.add_url_rule("/users-core/", view_func=CoreUsersView.as_view("users_core"))
+
+        class CoreStreamingUsersView(QueryFiltering, SACollectionView):
+            model = User
+            query_class = db_session.query
+            stream = True
+            stream_batch_size = 2
+            core_select = True
+        app.add_url_rule("/users-core-stream/", view_func=CoreStreamingUsersView.as_view("users_core_stream"))
+
+        class CoreUsersByKeyView(PaginableByKey, SACollectionView):
+            model = User
+            query_class = db_session.query
+            key_columns = ("username",)
+            max_limit = 2
+            core_select = True
+        app.add_url_rule("/users-core-by-key/", view_func=CoreUsersByKeyView.as_view("users_core_by_key"))
+
         self.app = app.test_client()
 
     def test_get(self):
@@ -150,6 +339,280 @@ class SQLAlchemyModelTestCase(unittest.TestCase):
         })
         self.assertEqual(response.status_code, 304, response.status)
 
+    def test_get_collection_streaming(self):
+        for username in ("", "spam"):
+            response = self.app.get("/users-stream/?auth=" + username, headers={"Accept": "application/json"})
+            self.assertEqual(response.status_code, 200, response.status)
+            self.assertTrue(response.headers.get("ETag", None) is None)
+
+            data = json.loads(response.data)
+            self.assertEqual(set(data_item["username"] for data_item in data), set(["spam", "ham", "eggs"]))
+            for data_item in data:
+                if data_item["username"] == username:
+                    self.assertEqual(data_item.get("email", None), username + "@users.example.org")
+                else:
+                    self.assertTrue(data_item.get("email", None) is None)
+                if data_item["username"] != "eggs":
+                    self.assertTrue(data_item["company"]["href"].startswith("/companies/"))
+
+        response = self.app.get("/users-stream/?username=nobody", headers={"Accept": "application/json"})
+        self.assertEqual(response.status_code, 200, response.status)
+        self.assertEqual(json.loads(response.data), [])
+
+    def test_streaming_without_stream_with_context(self):
+        # Old Flask versions can't stream with request context, so
+        # the output is buffered instead
+        headers = {"Accept": "application/json"}
+        response = self.app.get("/users-stream/?auth=spam", headers=headers)
+        self.assertTrue(response.headers.get("Content-Length") is None)
+        body = response.data
+        stream_with_context = views.stream_with_context
+        views.stream_with_context = None
+        try:
+            response = self.app.get("/users-stream/?auth=spam", headers=headers)
+        finally:
+            views.stream_with_context = stream_with_context
+        self.assertEqual(response.headers.get("Content-Length"), str(len(body)))
+        self.assertEqual(response.data, body)
+
+    def test_streaming_permissions_memo(self):
+        # Permissions of a streamed batch are forgotten before the next one
+        cached = []
+        check = User.__dict__["check_instances_permissions"]
+        def counting_check(cls, objs):
+            cached.append(len([key for key in g.toybox_permissions
+                               if key[0] == "instance" and key[1][0] is User]))
+            return check.__get__(None, cls)(objs)
+        User.check_instances_permissions = classmethod(counting_check)
+        try:
+            response = self.app.get("/users-stream/?auth=spam", headers={"Accept": "application/json"})
+            self.assertEqual(len(json.loads(response.data)), 3)
+        finally:
+            User.check_instances_permissions = check
+        self.assertEqual(cached, [0, 0])
+
+    def test_get_collection_ndjson(self):
+        response = self.app.get("/users/?auth=spam", headers={"Accept": "application/x-ndjson"})
+        self.assertEqual(response.status_code, 200, response.status)
+        self.assertEqual(response.mimetype, "application/x-ndjson")
+        lines = response.data.splitlines()
+        self.assertEqual(len(lines), 3)
+        data = [json.loads(line) for line in lines]
+        self.assertEqual([data_item["username"] for data_item in data], ["eggs", "ham", "spam"])
+        self.assertEqual(data[2]["email"], "spam@users.example.org")
+        self.assertTrue("email" not in data[0])
+
+        response = self.app.get("/users/spam", headers={"Accept": "application/x-ndjson"})
+        self.assertEqual(response.status_code, 200, response.status)
+        self.assertEqual(json.loads(response.data)["username"], "spam")
+
+    def test_compression(self):
+        import zlib
+        self.real_app.config["TOYBOX_COMPRESSION_MIN_SIZE"] = 0
+        plain = self.app.get("/users/", headers={"Accept": "application/json"})
+        self.assertTrue("Content-Encoding" not in plain.headers)
+        self.assertTrue("accept-encoding" in plain.headers["Vary"].lower())
+
+        for encoding, wbits in (("gzip", 16 + zlib.MAX_WBITS), ("deflate", zlib.MAX_WBITS)):
+            for url in ("/users/", "/users-stream/"):
+                response = self.app.get(url, headers={
+                    "Accept": "application/json",
+                    "Accept-Encoding": "identity, {0}".format(encoding)
+                })
+                self.assertEqual(response.status_code, 200, response.status)
+                self.assertEqual(response.headers["Content-Encoding"], encoding)
+                data = zlib.decompress(response.data, wbits)
+                key = lambda data_item: data_item["username"]
+                self.assertEqual(sorted(json.loads(data), key=key),
+                                 sorted(json.loads(plain.data), key=key))
+                if url == "/users/":
+                    etag = response.headers.get("ETag", None)
+                    self.assertEqual(response.get_etag()[0], plain.get_etag()[0] + "-" + encoding)
+
+            response = self.app.get("/users/", headers={
+                "Accept": "application/json",
+                "Accept-Encoding": encoding,
+                "If-None-Match": etag
+            })
+            self.assertEqual(response.status_code, 304, response.status)
+
+        response = self.app.get("/users/", headers={
+            "Accept": "application/json",
+            "Accept-Encoding": "gzip;q=0"
+        })
+        self.assertTrue("Content-Encoding" not in response.headers)
+
+        self.real_app.config["TOYBOX_COMPRESSION_MIN_SIZE"] = 100000
+        response = self.app.get("/users/", headers={
+            "Accept": "application/json",
+            "Accept-Encoding": "gzip"
+        })
+        self.assertTrue("Content-Encoding" not in response.headers)
+        self.assertEqual(response.headers.get("ETag"), plain.headers.get("ETag"))
+
+    def test_sparse_fields(self):
+        response = self.app.get("/users/?auth=spam&fields=username,email,company", headers={"Accept": "application/json"})
+        self.assertEqual(response.status_code, 200, response.status)
+        data = json.loads(response.data)
+        self.assertEqual(len(data), 3)
+        for data_item in data:
+            expected = set(["username", "company"])
+            if data_item["username"] == "spam":
+                expected.add("email")
+                self.assertEqual(data_item["company"]["name"], "The Spanish Inquisition")
+            self.assertEqual(set(data_item.keys()), expected)
+
+        response = self.app.get("/users/spam?fields=fullname", headers={"Accept": "application/json"})
+        self.assertEqual(response.status_code, 200, response.status)
+        self.assertEqual(json.loads(response.data), {"fullname": "Spam"})
+
+        for fields in ("nonexistent", "username,company_id"):
+            response = self.app.get("/users/spam?fields=" + fields, headers={"Accept": "application/json"})
+            self.assertEqual(response.status_code, 422, response.status)
+
+        # Fields not readable by the client are rejected, not omitted
+        response = self.app.get("/users/spam?fields=username,email", headers={"Accept": "application/json"})
+        self.assertEqual(response.status_code, 422, response.status)
+        self.assertTrue("&quot;email&quot;" in response.data, response.data)
+        response = self.app.get("/users/spam?auth=spam&fields=username,email", headers={"Accept": "application/json"})
+        self.assertEqual(response.status_code, 200, response.status)
+        self.assertEqual(json.loads(response.data), {"username": "spam", "email": "spam@users.example.org"})
+
+    def test_sparse_fields_deferred(self):
+        from sqlalchemy.orm.attributes import instance_state
+        with self.real_app.test_request_context("/users/?fields=username"):
+            view = self.real_app.view_functions["users"].view_class()
+            g.toybox_fields = view.get_fields()
+            for user in view.get_query().all():
+                unloaded = instance_state(user).unloaded
+                self.assertTrue("email" in unloaded)
+                self.assertTrue("username" not in unloaded)
+                self.assertTrue("company_id" not in unloaded)
+
+    def use_class_permissions(self):
+        # Class-level permissions, consistent with instance-level ones
+        def check_class_permissions(cls, user=None):
+            return set(["authenticated"]) if request.args.get("auth", "") != "" else set(["anonymous"])
+        for model in (User, Company):
+            model.check_class_permissions = classmethod(check_class_permissions)
+            self.addCleanup(delattr, model, "check_class_permissions")
+
+    def test_unreadable_deferred(self):
+        from sqlalchemy.orm.attributes import instance_state
+        self.use_class_permissions()
+        self.db_session.expire_all()
+        with self.real_app.test_request_context("/users/"):
+            view = self.real_app.view_functions["users"].view_class()
+            g.toybox_fields = view.get_fields()
+            for user in view.get_query().all():
+                unloaded = instance_state(user).unloaded
+                self.assertTrue("email" in unloaded)
+                self.assertTrue("is_staff" in unloaded)
+                self.assertTrue("username" not in unloaded)
+        self.db_session.expire_all()
+
+        # Instance-level grants load the column lazily
+        response = self.app.get("/users/?auth=spam", headers={"Accept": "application/json"})
+        self.assertEqual(response.status_code, 200, response.status)
+        data = dict((item["username"], item) for item in json.loads(response.data))
+        self.assertEqual(data["spam"]["email"], "spam@users.example.org")
+        self.assertTrue("email" not in data["eggs"])
+
+        # But collections can't be asked for fields class-level
+        # permissions don't allow to read
+        response = self.app.get("/users/?auth=spam&fields=username,email,is_staff",
+                                headers={"Accept": "application/json"})
+        self.assertEqual(response.status_code, 422, response.status)
+        self.assertTrue("&quot;email&quot;, &quot;is_staff&quot;" in response.data, response.data)
+
+    def test_columns_cache(self):
+        columns = User.get_columns()
+        self.assertEqual(columns[0].name, "id")
+        self.assertTrue(User._get_columns() is User._get_columns())
+        self.assertTrue(User.get_columns is User.get_columns)
+        readable = User._get_columns(False, "readable", ["anonymous"])
+        self.assertTrue(readable is User._get_columns(False, "readable", set(["anonymous"])))
+        self.assertTrue("email" not in [c.name for c in readable])
+
+        # Configuring a new mapper invalidates the cache
+        class Spam(declarative_base(), SAModelMixin):
+            __tablename__ = "test_spam"
+            id = Column(Integer, primary_key=True)
+        self.assertEqual([c.name for c in Spam.get_columns()], ["id"])
+        self.assertFalse(readable is User._get_columns(False, "readable", ["anonymous"]))
+
+    def test_serialization_plans(self):
+        company_column = [c for c in User.get_columns() if c.name == "company"][0]
+        plan = Company._get_plan(["anonymous"], company_column)
+        self.assertTrue(plan is Company._get_plan(set(["anonymous"]), company_column))
+        self.assertFalse(plan is Company._get_plan(["anonymous"]))
+
+        company = self.db_session.query(Company).filter_by(id=1).one()
+        self.assertEqual(plan.apply(company), {"href": "/companies/1", "name": "The Spanish Inquisition"})
+        self.assertEqual(list(Company._get_plan().apply(company).keys()), ["id", "name", "is_expected"])
+
+    def test_embedded_not_copied(self):
+        user = self.db_session.query(User).filter_by(username="spam").one()
+        data = user.as_dict(check_permissions=False)
+        self.assertTrue(data["company"].obj is user.company)
+        self.assertEqual(data["company"].name, "The Spanish Inquisition")
+        self.assertEqual(data["company"].as_dict(check_permissions=False),
+                         {"href": "/companies/1", "name": "The Spanish Inquisition"})
+        try:
+            import yaml
+        except ImportError:
+            return
+        with self.real_app.test_request_context("/"):
+            self.assertEqual(yaml.safe_load(yaml.safe_dump(user))["company"],
+                             {"href": "/companies/1", "name": "The Spanish Inquisition"})
+
+    def count_request(self, method, url, **kwargs):
+        statements = []
+        def before_cursor_execute(conn, cursor, statement, *args):
+            statements.append(statement)
+        event.listen(self.engine, "before_cursor_execute", before_cursor_execute)
+        try:
+            response = getattr(self.app, method)(url, **kwargs)
+            # Streamed responses run their queries while being read
+            response.data
+        finally:
+            event.remove(self.engine, "before_cursor_execute", before_cursor_execute)
+        return response, len(statements)
+
+    def count_statements(self, url):
+        response, count = self.count_request("get", url, headers={"Accept": "application/json"})
+        self.assertEqual(response.status_code, 200, response.status)
+        return json.loads(response.data), count
+
+    def test_eager_loading(self):
+        eager_data, eager_count = self.count_statements("/users/")
+        self.db_session.expire_all()
+        lazy_data, lazy_count = self.count_statements("/users-lazy/")
+        self.assertEqual(eager_count, 1)
+        self.assertEqual(lazy_count, 3)
+        key = lambda data_item: data_item["username"]
+        self.assertEqual(sorted(eager_data, key=key), sorted(lazy_data, key=key))
+
+        self.db_session.expire_all()
+        data, count = self.count_statements("/users-stream/")
+        self.assertEqual(count, 1)
+
+    def test_permissions_memoized(self):
+        data, count = self.count_statements("/users/spam?auth=spam")
+        self.assertEqual(data["email"], "spam@users.example.org")
+        # One to fetch the object, one to check permissions
+        self.assertEqual(count, 2)
+
+        # One to fetch the objects, one per page (or batch of 2 rows
+        # for streaming) to check permissions in bulk
+        for url, expected in (("/users/?auth=spam", 2), ("/users-stream/?auth=spam", 3)):
+            self.db_session.expire_all()
+            data, count = self.count_statements(url)
+            self.assertEqual(len(data), 3)
+            for data_item in data:
+                self.assertEqual("email" in data_item, data_item["username"] == "spam")
+            self.assertEqual(count, expected)
+
     def test_collection_pagination(self):
         response = self.app.get("/users/", headers={"Accept": "application/json", "Range": "items=1-10"})
         self.assertEqual(response.status_code, 206, response.status)
@@ -160,6 +623,459 @@ class SQLAlchemyModelTestCase(unittest.TestCase):
         usernames = [data_item.get("username", None) for data_item in data]
         self.assertEqual(usernames, ["ham", "spam"])
 
+    def get_links(self, response):
+        links = {}
+        for link in response.headers.get("Link", "").split(","):
+            if link.strip():
+                url, rel = link.split(";")
+                url = urlparse.urlsplit(url.strip()[1:-1])
+                links[rel.strip()[5:-1]] = url.path + "?" + url.query
+        return links
+
+    def test_collection_pagination_by_key(self):
+        response = self.app.get("/users-by-key/", headers={"Accept": "application/json"})
+        self.assertEqual(response.status_code, 200, response.status)
+        self.assertEqual([data_item["username"] for data_item in json.loads(response.data)], ["eggs", "ham"])
+        links = self.get_links(response)
+        self.assertEqual(set(links.keys()), set(["next"]))
+
+        response = self.app.get(links["next"], headers={"Accept": "application/json"})
+        self.assertEqual(response.status_code, 200, response.status)
+        self.assertEqual([data_item["username"] for data_item in json.loads(response.data)], ["spam"])
+        links = self.get_links(response)
+        self.assertEqual(set(links.keys()), set(["prev"]))
+
+        response = self.app.get(links["prev"], headers={"Accept": "application/json"})
+        self.assertEqual(response.status_code, 200, response.status)
+        self.assertEqual([data_item["username"] for data_item in json.loads(response.data)], ["eggs", "ham"])
+        links = self.get_links(response)
+        self.assertEqual(set(links.keys()), set(["next"]))
+
+        cursor = PaginableByKey.encode_cursor("next", ["eggs"])
+        response = self.app.get("/users-by-key/?limit=1&is_staff=true", headers={
+            "Accept": "application/json", "Range": "cursor=" + cursor})
+        self.assertEqual(response.status_code, 200, response.status)
+        self.assertEqual([data_item["username"] for data_item in json.loads(response.data)], ["spam"])
+        self.assertTrue("is_staff=true" in self.get_links(response)["prev"])
+
+        for query, headers, status in (("?cursor=spam", {}, 400),
+                                       ("?limit=0", {}, 400),
+                                       ("", {"Range": "items=0-1"}, 416)):
+            headers["Accept"] = "application/json"
+            response = self.app.get("/users-by-key/" + query, headers=headers)
+            self.assertEqual(response.status_code, status, response.status)
+
+    def test_collection_pagination_total(self):
+        for total_count in ("count", "window", "estimate"):
+            url = "/users-" + total_count + "/"
+            for query, range, expected in (("", "items=1-10", "items 1-2/3"),
+                                           ("?is_staff=true", "items=0-0", "items 0-0/2"),
+                                           ("", "items=5-6", "items */3")):
+                response = self.app.get(url + query, headers={"Accept": "application/json", "Range": range})
+                self.assertEqual(response.status_code, 206, response.status)
+                self.assertEqual(response.headers.get("Content-Range", ""), expected)
+            response = self.app.get(url, headers={"Accept": "application/json", "Range": "items=0-0"})
+            self.assertEqual(json.loads(response.data)[0]["username"], "eggs")
+
+        # Estimates are cached
+        self.db_session.add(User("bacon", "Bacon", "bacon@users.example.org"))
+        self.db_session.commit()
+        for total_count, expected in (("count", "items 0-0/4"), ("window", "items 0-0/4"), ("estimate", "items 0-0/3")):
+            response = self.app.get("/users-" + total_count + "/", headers={"Accept": "application/json", "Range": "items=0-0"})
+            self.assertEqual(response.headers.get("Content-Range", ""), expected)
+
+    def test_visibility(self):
+        def visible_to(cls, levels, user):
+            return None if "admin" in levels else cls.is_active == True
+        User.visible_to = classmethod(visible_to)
+        try:
+            response = self.app.get("/users/", headers={"Accept": "application/json"})
+            self.assertEqual(set(item["username"] for item in json.loads(response.data)),
+                             set(["spam", "eggs"]))
+            for total_count in ("count", "window", "estimate"):
+                response = self.app.get("/users-" + total_count + "/?badges=lt:2", headers={
+                    "Accept": "application/json",
+                    "Range": "items=0-10"
+                })
+                self.assertEqual(response.headers.get("Content-Range", ""), "items 0-0/1")
+                self.assertEqual([item["username"] for item in json.loads(response.data)], ["spam"])
+            response = self.app.get("/users/?is_active=false", headers={"Accept": "application/json"})
+            self.assertEqual(json.loads(response.data), [])
+            response = self.app.get("/users-by-key/?limit=1", headers={"Accept": "application/json"})
+            response = self.app.get(self.get_links(response)["next"], headers={"Accept": "application/json"})
+            self.assertEqual([item["username"] for item in json.loads(response.data)], ["spam"])
+            response = self.app.get("/users/ham", headers={"Accept": "application/json"})
+            self.assertEqual(response.status_code, 404, response.status)
+        finally:
+            del User.visible_to
+
+    def test_core_select(self):
+        key = lambda data_item: data_item["username"]
+        for query in ("?fields=username,email", "?auth=spam&fields=username,email",
+                      "?auth=spam&fields=username,is_staff&badges=lt:2"):
+            response = self.app.get("/users/" + query, headers={"Accept": "application/json"})
+            expected = sorted(json.loads(response.data), key=key)
+            for url in ("/users-core/", "/users-core-stream/"):
+                response = self.app.get(url + query, headers={"Accept": "application/json"})
+                self.assertEqual(response.status_code, 200, response.status)
+                self.assertEqual(sorted(json.loads(response.data), key=key), expected)
+
+        # No model instances are created, unless relationships are output
+        loaded = []
+        def load(target, context):
+            loaded.append(target)
+        event.listen(User, "load", load)
+        try:
+            self.db_session.expunge_all()
+            data, count = self.count_statements("/users-core/?fields=username,fullname")
+            self.assertEqual(count, 1)
+            self.assertEqual(loaded, [])
+            self.assertEqual([data_item["username"] for data_item in data], ["eggs", "ham", "spam"])
+
+            data, count = self.count_statements("/users-core/")
+            self.assertEqual(len(loaded), 3)
+            self.assertEqual(data[2]["company"]["name"], "The Spanish Inquisition")
+        finally:
+            event.remove(User, "load", load)
+
+        response = self.app.get("/users-core/?fields=username", headers={
+            "Accept": "application/json",
+            "Range": "items=1-1"
+        })
+        self.assertEqual(response.headers.get("Content-Range", ""), "items 1-1/3")
+        self.assertEqual(json.loads(response.data), [{"username": "ham"}])
+
+        response = self.app.get("/users-core-by-key/?fields=username", headers={"Accept": "application/json"})
+        self.assertEqual(json.loads(response.data), [{"username": "eggs"}, {"username": "ham"}])
+        response = self.app.get(self.get_links(response)["next"], headers={"Accept": "application/json"})
+        self.assertEqual(json.loads(response.data), [{"username": "spam"}])
+
+        # Without bulk permission checks, instance permissions can't be told
+        # for rows, so the ORM is used
+        check = User.__dict__["check_instances_permissions"]
+        del User.check_instances_permissions
+        try:
+            query = "?fields=username,email,is_staff"
+            response = self.app.get("/users/" + query, headers={"Accept": "application/json"})
+            expected = sorted(json.loads(response.data), key=key)
+            self.assertEqual(set(expected[0].keys()), set(["username"]))
+            for url in ("/users-core/", "/users-core-stream/"):
+                response = self.app.get(url + query, headers={"Accept": "application/json"})
+                self.assertEqual(sorted(json.loads(response.data), key=key), expected)
+        finally:
+            User.check_instances_permissions = check
+
+        # Rows have only the columns permission checks are declared to need
+        def check_instances_permissions(cls, objs):
+            return [set(["staff"]) if obj.is_staff else set(["anonymous"]) for obj in objs]
+        User.check_instances_permissions = classmethod(check_instances_permissions)
+        try:
+            for columns, expected_loads in ((None, 3), (("is_staff",), 0)):
+                User.permissions_columns = columns
+                del loaded[:]
+                event.listen(User, "load", load)
+                try:
+                    self.db_session.expunge_all()
+                    data, count = self.count_statements("/users-core/?fields=username,email")
+                finally:
+                    event.remove(User, "load", load)
+                self.assertEqual(len(loaded), expected_loads)
+                self.assertEqual([sorted(data_item.keys()) for data_item in data],
+                                 [["email", "username"], ["username"], ["email", "username"]])
+        finally:
+            User.check_instances_permissions = check
+            User.permissions_columns = ()
+
+        # Overridden `as_dict` is always called
+        def as_dict(self, *args, **kwargs):
+            return dict(SAModelMixin.as_dict(self, *args, **kwargs), spam=True)
+        User.as_dict = as_dict
+        try:
+            response = self.app.get("/users-core/?fields=username", headers={"Accept": "application/json"})
+            self.assertEqual([data_item["spam"] for data_item in json.loads(response.data)], [True] * 3)
+        finally:
+            del User.as_dict
+
+    @unittest.skipIf(baked is None, "SQLAlchemy baked queries are not available")
+    def test_baked_queries(self):
+        compiled = []
+        compile_context = Query._compile_context
+        def counting_compile_context(query, *args, **kwargs):
+            compiled.append(query)
+            return compile_context(query, *args, **kwargs)
+        Query._compile_context = counting_compile_context
+        try:
+            for username in ("spam", "eggs", "ham"):
+                response = self.app.get("/users-baked/" + username, headers={"Accept": "application/json"})
+                self.assertEqual(response.status_code, 200, response.status)
+                self.assertEqual(json.loads(response.data)["username"], username)
+            response = self.app.get("/users-baked/nobody", headers={"Accept": "application/json"})
+            self.assertEqual(response.status_code, 404, response.status)
+            self.assertEqual(len(compiled), 1)
+
+            del compiled[:]
+            for query, expected in (("badges=lt:2", set(["ham", "spam"])),
+                                    ("badges=lt:1", set(["ham"])),
+                                    ("badges=lt:3", set(["ham", "spam", "eggs"])),
+                                    ("badges=ne:null", set(["ham", "spam", "eggs"])),
+                                    ("is_staff=\"true\"", set())):
+                response = self.app.get("/users-baked/?" + query, headers={"Accept": "application/json"})
+                self.assertEqual(set(data_item["username"] for data_item in json.loads(response.data)), expected)
+            # Same filter operator with other values reuses the statement
+            self.assertEqual(len(compiled), 3)
+        finally:
+            Query._compile_context = compile_context
+
+    def test_result_cache(self):
+        self.use_class_permissions()
+        def get(url, **headers):
+            headers["Accept"] = "application/json"
+            return self.count_request("get", url, headers=headers)
+
+        first, count = get("/users-cached/", Range="items=0-1")
+        self.assertTrue(count > 0)
+        second, count = get("/users-cached/", Range="items=0-1")
+        self.assertEqual(count, 0)
+        self.assertEqual(second.status_code, 206)
+        self.assertEqual(second.data, first.data)
+        self.assertEqual(second.headers.get("Content-Range"), "items 0-1/*")
+        self.assertEqual(second.headers.get("ETag"), first.headers.get("ETag"))
+
+        response, count = get("/users-cached/", Range="items=0-1", **{"If-None-Match": first.headers["ETag"]})
+        self.assertEqual((response.status_code, count), (304, 0))
+
+        # Other requests are cached separately
+        response, count = get("/users-cached/?badges=2", Range="items=0-1")
+        self.assertTrue(count > 0)
+        self.assertEqual(len(json.loads(response.data)), 1)
+
+        # Responses with instance-level grants are specific to the caller
+        for url in ("/users-cached/?auth=spam", "/users-cached/?auth=spam&username=eggs"):
+            response, count = get(url)
+            response, count = get(url)
+            self.assertEqual(count > 0, url == "/users-cached/?auth=spam")
+
+        # Commits invalidate affected tables, including related ones
+        self.db_session.query(User).filter_by(username="eggs").one().fullname = "Bacon"
+        self.db_session.commit()
+        response, count = get("/users-cached/", Range="items=0-1")
+        self.assertTrue(count > 0)
+        self.assertEqual(json.loads(response.data)[0]["fullname"], "Bacon")
+        self.db_session.query(Company).filter_by(name="The Vikings").update({"name": "The Danes"})
+        self.db_session.commit()
+        response, count = get("/users-cached/", Range="items=0-1")
+        self.assertTrue(count > 0)
+        self.assertEqual(json.loads(response.data)[1]["company"]["name"], "The Danes")
+
+    def test_etag_index(self):
+        self.use_class_permissions()
+        def request(method, url, **headers):
+            headers["Accept"] = "application/json"
+            return self.count_request(method, url, headers=headers,
+                data=json.dumps({"fullname": "Python Eggs"}),
+                content_type="application/json")
+
+        for url in ("/users-indexed/eggs", "/users-indexed/"):
+            response, count = request("get", url)
+            self.assertTrue(count > 0)
+            etag = response.headers["ETag"]
+            response, count = request("get", url, **{"If-None-Match": etag})
+            self.assertEqual((response.status_code, count), (304, 0))
+            # Unknown ETags are checked as usual
+            response, count = request("get", url, **{"If-None-Match": '"nope"'})
+            self.assertEqual(response.status_code, 200)
+            self.assertTrue(count > 0)
+
+        response, count = request("patch", "/users-indexed/eggs", **{"If-Match": '"nope"'})
+        self.assertEqual((response.status_code, count), (412, 0))
+        response, count = request("patch", "/users-indexed/eggs")
+        self.assertEqual((response.status_code, count), (428, 0))
+
+        # Commits invalidate the index
+        response, count = request("get", "/users-indexed/eggs")
+        etag = response.headers["ETag"]
+        response, count = request("patch", "/users-indexed/eggs", **{"If-Match": etag})
+        self.assertEqual(response.status_code, 204, response.data)
+        response, count = request("get", "/users-indexed/eggs", **{"If-None-Match": etag})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(json.loads(response.data)["fullname"], "Python Eggs")
+
+    def test_last_modified(self):
+        headers = {"Accept": "application/json"}
+        times = [datetime(2020, 1, 1, 12, 0, 0, 500), datetime(2020, 1, 2, 12, 0, 0)]
+        for company, updated_at in zip(self.db_session.query(VersionedCompany).order_by(VersionedCompany.id), times):
+            company.updated_at = updated_at
+        self.db_session.commit()
+        company = self.db_session.query(VersionedCompany).order_by(VersionedCompany.id).first()
+
+        # Collections' modification times are only hints, not validators
+        for url, modified, unmodified in (("/versioned-companies/{0}".format(company.id), times[0], 304),
+                                          ("/versioned-companies/", times[1], 200)):
+            response = self.app.get(url, headers=headers)
+            self.assertEqual(response.status_code, 200)
+            self.assertEqual(response.headers.get("Last-Modified"), http_date(modified))
+            self.assertEqual(response.cache_control.max_age, 60)
+
+            for since, status in ((modified, unmodified), (modified - timedelta(seconds=1), 200),
+                                  (modified + timedelta(days=1), unmodified)):
+                response = self.app.get(url, headers=dict(headers, **{
+                    "If-Modified-Since": http_date(since)}))
+                self.assertEqual(response.status_code, status, since)
+
+            # If-None-Match takes precedence
+            response = self.app.get(url, headers=dict(headers, **{
+                "If-Modified-Since": http_date(modified),
+                "If-None-Match": '"nope"'}))
+            self.assertEqual(response.status_code, 200)
+
+        self.assertTrue(response.cache_control.private)
+        response = self.app.get("/versioned-companies/?fields=name", headers=headers)
+        self.assertEqual(response.headers.get("Last-Modified"), http_date(times[1]))
+
+        # Models declare modification time columns explicitly
+        self.assertTrue(SAModelMixin.last_modified_column is None)
+        response = self.app.get("/users/eggs", headers=headers)
+        self.assertTrue(response.headers.get("Last-Modified") is None)
+        self.assertTrue(response.headers.get("Cache-Control") is None)
+
+        # Modifying requests check If-Unmodified-Since
+        response = self.app.get("/versioned-companies/{0}".format(company.id), headers=headers)
+        etag = response.headers["ETag"]
+        response = self.app.patch("/versioned-companies/{0}".format(company.id),
+            headers=dict(headers, **{"If-Match": etag,
+                                     "If-Unmodified-Since": http_date(times[0] - timedelta(days=1))}),
+            data=json.dumps({"name": "Spam"}), content_type="application/json")
+        self.assertEqual(response.status_code, 412)
+
+        # Removal of items doesn't change collection's Last-Modified
+        response = self.app.get("/versioned-companies/", headers=headers)
+        last_modified = response.headers["Last-Modified"]
+        self.db_session.query(VersionedCompany).filter_by(name="The Spanish Inquisition").delete()
+        self.db_session.commit()
+        response = self.app.get("/versioned-companies/", headers=dict(headers, **{
+            "If-Modified-Since": last_modified}))
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.headers["Last-Modified"], last_modified)
+        self.assertEqual(len(json.loads(response.data)), 1)
+
+    def test_version_etags(self):
+        # Models declare version columns explicitly
+        self.assertTrue(SAModelMixin.etag_version_column is None)
+        serialized = []
+        serialize = JSON.__dict__["serialize"]
+        def counting_serialize(cls, obj):
+            serialized.append(obj)
+            return serialize.__get__(None, cls)(obj)
+        JSON.serialize = classmethod(counting_serialize)
+        try:
+            response = self.app.get("/versioned-users/spam", headers={"Accept": "application/json"})
+            etag = response.headers["ETag"]
+            self.assertEqual(len(serialized), 1)
+            del serialized[:]
+            response = self.app.get("/versioned-users/spam", headers={"Accept": "application/json", "If-None-Match": etag})
+            self.assertEqual(response.status_code, 304)
+            self.assertEqual(serialized, [])
+
+            etags = set([etag])
+            for url in ("/versioned-users/spam?fields=username", "/versioned-users/spam?auth=spam", "/versioned-users/eggs"):
+                response = self.app.get(url, headers={"Accept": "application/json"})
+                etags.add(response.headers["ETag"])
+            self.assertEqual(len(etags), 4)
+
+            # Access levels of embedded objects are a part of the ETag
+            check = VersionedCompany.__dict__["check_instance_permissions"]
+            VersionedCompany.check_instance_permissions = lambda self, user=None: set(["admin"])
+            try:
+                response = self.app.get("/versioned-users/spam", headers={"Accept": "application/json", "If-None-Match": etag})
+                self.assertEqual(response.status_code, 200)
+            finally:
+                VersionedCompany.check_instance_permissions = check
+
+            # Changes to the object or embedded objects change the ETag
+            user = self.db_session.query(VersionedUser).filter_by(username="spam").one()
+            for obj, name in ((user, "fullname"), (user.company, "name")):
+                setattr(obj, name, "Changed")
+                self.db_session.commit()
+                response = self.app.get("/versioned-users/spam", headers={"Accept": "application/json", "If-None-Match": etag})
+                self.assertEqual(response.status_code, 200)
+                self.assertNotEqual(response.headers["ETag"], etag)
+                etag = response.headers["ETag"]
+        finally:
+            JSON.serialize = serialize
+
+    def test_pagination_etags(self):
+        def get(url, etag=None, **headers):
+            headers["Accept"] = "application/json"
+            if etag is not None:
+                headers["If-None-Match"] = etag
+            return self.app.get(url, headers=headers)
+
+        # Same items with other total or links have other ETags
+        cases = (("/users-count/", {"Range": "items=0-1"}), ("/users-by-key/", {}))
+        first = [get(url, **headers) for url, headers in cases]
+        self.db_session.query(User).filter_by(username="spam").delete()
+        self.db_session.commit()
+        for (url, headers), response in zip(cases, first):
+            second = get(url, response.headers["ETag"], **headers)
+            self.assertEqual(second.status_code, response.status_code, url)
+            self.assertEqual(second.data, response.data)
+            self.assertNotEqual(second.headers["ETag"], response.headers["ETag"])
+            self.assertEqual(get(url, second.headers["ETag"], **headers).status_code, 304)
+
+    def test_aggregate_etags(self):
+        loaded = []
+        def load(target, context):
+            loaded.append(target)
+        event.listen(VersionedUser, "load", load)
+        try:
+            url = "/versioned-users/?fields=username,fullname"
+            response = self.app.get(url, headers={"Accept": "application/json", "Range": "items=0-1"})
+            etag = response.headers["ETag"]
+            self.assertEqual(len(loaded), 2)
+
+            del loaded[:]
+            self.db_session.expire_all()
+            for query in ("", "&badges=2"):
+                response = self.app.get(url + query, headers={"Accept": "application/json", "Range": "items=0-1",
+                                                              "If-None-Match": etag})
+                self.assertEqual(response.status_code, 304 if query == "" else 206)
+            # Only the filtered request has loaded any rows
+            self.assertEqual(len(loaded), 1)
+
+            # Changes, other pages and other fields change the ETag
+            etags = set([etag])
+            for range in ("items=1-2", "items=0-0"):
+                response = self.app.get(url, headers={"Accept": "application/json", "Range": range})
+                etags.add(response.headers["ETag"])
+            response = self.app.get(url + ",badges", headers={"Accept": "application/json", "Range": "items=0-1"})
+            etags.add(response.headers["ETag"])
+            self.db_session.query(VersionedUser).filter_by(username="eggs").one().fullname = "Bacon"
+            self.db_session.commit()
+            response = self.app.get(url, headers={"Accept": "application/json", "Range": "items=0-1",
+                                                  "If-None-Match": etag})
+            self.assertEqual(response.status_code, 206)
+            etags.add(response.headers["ETag"])
+            self.assertEqual(len(etags), 5)
+
+            # Versions are tied to rows, so swapping them is noticed
+            swapped = dict(self.db_session.query(VersionedUser.id, VersionedUser.version).filter(
+                VersionedUser.username.in_(["eggs", "ham"])).all())
+            ids = sorted(swapped)
+            for id, version in zip(ids, reversed([swapped[id] for id in ids])):
+                self.db_session.execute(VersionedUser.__table__.update().where(
+                    VersionedUser.id == id).values(version=version))
+            self.db_session.commit()
+            response = self.app.get(url, headers={"Accept": "application/json", "Range": "items=0-1",
+                                                  "If-None-Match": response.headers["ETag"]})
+            self.assertEqual(response.status_code, 206)
+
+            # Relationships require loading the rows
+            response = self.app.get("/versioned-users/", headers={"Accept": "application/json"})
+            self.assertTrue("company" in json.loads(response.data)[2])
+            self.assertTrue(response.headers.get("ETag") is not None)
+        finally:
+            event.remove(VersionedUser, "load", load)
+
     def test_collection_filtering(self):
         cases = [
             # This also tests whenever is_admin will be ignored, as it is not readable.
@@ -235,6 +1151,21 @@ class SQLAlchemyModelTestCase(unittest.TestCase):
         self.assertTrue("fullname" in data)
         self.assertEqual(data["fullname"], "Python Eggs")
 
+    def test_patch_ndjson(self):
+        response = self.app.get("/users/eggs",
+                                headers={"Accept": "application/json"})
+        etag = response.headers.get("ETag", None)
+        response = self.app.patch(
+            "/users/eggs",
+            headers={
+                "Accept": "application/json",
+                "If-Match": etag
+            },
+            data='{"fullname": "Python Eggs"}\n',
+            content_type="application/x-ndjson"
+        )
+        self.assertEqual(response.status_code, 415, response.data)
+
     def test_patch_non_writeable(self):
         response = self.app.get("/users/eggs",
                                 headers={"Accept": "application/json"})